@@ -1,16 +1,16 @@
 import os
-import threading
-import socket
 from globalPluginHandler import GlobalPlugin
 import wx
 from config import conf
 from .configSpec import configSpec
 import gui
 from . import beep_sequence
-from .transport import RelayTransport, DVCTransport
+from . import heartbeat
+from .transport import RelayTransport, DVCTransport, LocalTransport, LocalListenerTransport, ReconnectPolicy
 import braille
 from . import local_machine
 from . import serializer
+from . import tracing
 from .session import MasterSession, SlaveSession
 import ui
 import addonHandler
@@ -21,10 +21,8 @@ import speech.priorities
 import globalVars
 import shlobj
 import uuid
-from . import server
 from . import bridge
 import api
-import ssl
 from . import callback_manager
 from . import unicorn
 import json
@@ -60,6 +58,7 @@ class GlobalPlugin(GlobalPlugin):
 				)
 			raise RuntimeError("UnicornDVC not found")
 		self.initializeConfig()
+		tracing.tracer.enabled = conf['unicorn']['traceLatency']
 		gui.settingsDialogs.NVDASettingsDialog.categoryClasses.append(dialogs.UnicornPanel)
 		self.local_machine = local_machine.LocalMachine()
 		self.callback_manager = callback_manager.CallbackManager()
@@ -68,14 +67,16 @@ class GlobalPlugin(GlobalPlugin):
 		self.create_menu()
 		self.master_transport = None
 		self.slave_transport = None
-		self.sd_server = None
-		self.sd_relay = None
+		self.sd_link = None
 		self.sd_bridge = None
 		self.temp_location = os.path.join(shlobj.SHGetFolderPath(0, shlobj.CSIDL_COMMON_APPDATA), 'temp')
 		self.ipc_file = os.path.join(self.temp_location, 'unicorn.ipc')
 		if globalVars.appArgs.secure:
 			self.handle_secure_desktop()
 		wx.CallLater(500, self.perform_autoconnect)
+		self.metrics_timer = None
+		if conf['unicorn']['metricsLogInterval']:
+			self.metrics_timer = wx.CallLater(conf['unicorn']['metricsLogInterval'] * 1000, self.log_metrics_periodically)
 		self.sd_focused = False
 		self.rs_focused = False
 
@@ -84,6 +85,17 @@ class GlobalPlugin(GlobalPlugin):
 			conf['unicorn'] = {}
 		conf['unicorn'].spec.update(configSpec)
 
+	def create_heartbeat(self):
+		return heartbeat.Heartbeat(interval=conf['unicorn']['heartbeatInterval'], max_missed=conf['unicorn']['maxMissedPongs'])
+
+	def create_reconnect_policy(self):
+		return ReconnectPolicy(
+			initial_delay=conf['unicorn']['reconnectInitialDelay'],
+			max_delay=conf['unicorn']['reconnectMaxDelay'],
+			jitter=conf['unicorn']['reconnectJitter'],
+			stable_time=conf['unicorn']['reconnectStableTime'],
+		)
+
 	def perform_autoconnect(self):
 		if conf['unicorn']['autoConnectClient'] and unicorn.unicorn_client():
 			self.connect_master()
@@ -125,6 +137,9 @@ class GlobalPlugin(GlobalPlugin):
 		self.submenu_item = gui.mainFrame.sysTrayIcon.menu.Insert(2, wx.ID_ANY, _("UnicornDVC"), self.menu)
 
 	def terminate(self):
+		if self.metrics_timer is not None:
+			self.metrics_timer.Stop()
+			self.metrics_timer = None
 		self.disconnect()
 		self.local_machine = None
 		if self.submenu_item is not None:
@@ -145,8 +160,12 @@ class GlobalPlugin(GlobalPlugin):
 			gui.settingsDialogs.NVDASettingsDialog.categoryClasses.remove(dialogs.UnicornPanel)
 
 	def connect_master(self):
+		if self.master_transport is not None:
+			# Waiting to reconnect after the connection was interrupted
+			self.reconnect_now()
+			return
 		try:
-			transport = DVCTransport(serializer=serializer.JSONSerializer(), connection_type='master')
+			transport = DVCTransport(serializer=serializer.JSONSerializer(), connection_type='master', compress=conf['unicorn']['compressTraffic'], reconnect_policy=self.create_reconnect_policy(), heartbeat=self.create_heartbeat())
 		except OSError as e:
 			self.on_initialize_failed(e)
 			return
@@ -157,19 +176,27 @@ class GlobalPlugin(GlobalPlugin):
 		transport.callback_manager.register_callback('transport_connection_failed', self.on_connected_as_master_failed)
 		transport.callback_manager.register_callback('transport_closing', self.disconnecting_as_master)
 		transport.callback_manager.register_callback('transport_disconnected', self.on_disconnected_as_master)
-		transport.callback_manager.register_callback('msg_client_joined', lambda **kwargs: self.evaluate_remote_shell())
+		transport.callback_manager.register_callback('msg_client_joined', self.on_client_joined_as_master)
 		self.master_transport = transport
 		self.master_transport.reconnector_thread.start()
 		self.disconnect_master_item.Enable()
 		self.connect_master_item.Enable(False)
 
 	def connect_slave(self):
+		if self.slave_transport is not None:
+			self.reconnect_now()
+			return
 		try:
-			transport = DVCTransport(serializer=serializer.JSONSerializer(), connection_type='slave')
+			transport = DVCTransport(serializer=serializer.JSONSerializer(), connection_type='slave', prune_speech=True, compress=conf['unicorn']['compressTraffic'], reconnect_policy=self.create_reconnect_policy(), heartbeat=self.create_heartbeat())
 		except OSError as e:
 			self.on_initialize_failed(e)
 			return
-		self.slave_session = SlaveSession(transport=transport, local_machine=self.local_machine, is_secondary=bool(self.master_transport))
+		self.slave_session = SlaveSession(
+			transport=transport,
+			local_machine=self.local_machine,
+			is_secondary=bool(self.master_transport),
+			display_frame_rate=conf['unicorn']['maxBrailleFrameRate']
+		)
 		self.slave_transport = transport
 		self.slave_transport.callback_manager.register_callback('transport_connected', self.on_connected_as_slave)
 		self.slave_transport.callback_manager.register_callback('msg_set_braille_info', self.send_braille_info_to_master)
@@ -178,6 +205,12 @@ class GlobalPlugin(GlobalPlugin):
 		self.connect_slave_item.Enable(False)
 		transport.callback_manager.register_callback('transport_connection_failed', self.on_connected_as_slave_failed)
 
+	def reconnect_now(self):
+		"""Connections waiting to reconnect try again right away, rather than after their back off delay."""
+		for transport in (self.master_transport, self.slave_transport):
+			if transport is not None and not transport.connected:
+				transport.reconnector_thread.retry_now()
+
 	def send_braille_info_to_master(self, *args, **kwargs):
 		if self.master_session:
 			self.master_session.send_braille_info(*args, **kwargs)
@@ -209,6 +242,8 @@ class GlobalPlugin(GlobalPlugin):
 
 	def disconnect_slave(self):
 		self.callback_manager.call_callbacks('transport_disconnect', connection_type='slave')
+		self.leave_secure_desktop()
+		self.close_secure_desktop_link()
 		self.slave_transport.close()
 		self.slave_transport = None
 		self.slave_session = None
@@ -225,6 +260,68 @@ class GlobalPlugin(GlobalPlugin):
 		self.mute_item.Check(self.local_machine.is_muted)
 	script_toggle_remote_mute.__doc__ = _("""Mute or unmute the speech coming from the remote computer""")
 
+	def script_reconnect(self, gesture):
+		if not any(transport is not None and not transport.connected for transport in (self.master_transport, self.slave_transport)):
+			# Translators: Reported when asked to reconnect while no connection is waiting to reconnect.
+			ui.message(_("No connection is waiting to reconnect"))
+			return
+		self.reconnect_now()
+		# Translators: Reported when the connections waiting to reconnect try again.
+		ui.message(_("Reconnecting"))
+	script_reconnect.__doc__ = _("""Makes interrupted connections try to reconnect right away""")
+
+	def script_log_callback_registrations(self, gesture):
+		managers = (
+			('plugin', self.callback_manager),
+			('master transport', self.master_transport and self.master_transport.callback_manager),
+			('slave transport', self.slave_transport and self.slave_transport.callback_manager),
+			('secure desktop link', self.sd_link and self.sd_link.callback_manager),
+		)
+		lines = []
+		for name, manager in managers:
+			if manager is None:
+				continue
+			counts = ", ".join(f"{event_type}: {count}" for event_type, count in sorted(manager.registration_counts().items(), key=str))
+			lines.append(f"{name}: {counts or 'none'}")
+		log.info("Callback registrations\n" + "\n".join(lines))
+		# Translators: Reported when the callback registrations have been written to the log.
+		ui.message(_("Callback registrations written to the log"))
+	script_log_callback_registrations.__doc__ = _("""Writes the number of registered callbacks for each event to the NVDA log""")
+
+	def get_metrics(self):
+		"""Returns the counters of the plugin's callback manager and of the active transports as text."""
+		transports = (self.master_transport, self.slave_transport, self.sd_link)
+		lines = [f"plugin callbacks: {self.callback_manager.metrics}"]
+		lines.extend(transport.metrics_summary() for transport in transports if transport is not None)
+		return "\n".join(lines)
+
+	def log_metrics_periodically(self):
+		try:
+			if self.master_transport is not None or self.slave_transport is not None:
+				log.info("Connection metrics\n" + self.get_metrics())
+		except Exception:
+			log.error("Could not log the connection metrics", exc_info=True)
+		finally:
+			# Periodic logging stops when the timer is not started again
+			if self.metrics_timer is not None:
+				self.metrics_timer.Start()
+
+	def script_log_metrics(self, gesture):
+		log.info("Connection metrics\n" + self.get_metrics())
+		# Translators: Reported when the connection metrics have been written to the log.
+		ui.message(_("Connection metrics written to the log"))
+	script_log_metrics.__doc__ = _("""Writes the message, queue, connection and callback counters of the connections to the NVDA log""")
+
+	def script_log_latency(self, gesture):
+		if not tracing.tracer.enabled:
+			# Translators: Reported when latency tracing is disabled in the configuration.
+			ui.message(_("Latency tracing is disabled"))
+			return
+		log.info("Latency of speech and braille from the remote computer, by stage\n" + (tracing.tracer.report() or "no samples"))
+		# Translators: Reported when the latency histograms have been written to the log.
+		ui.message(_("Latency histograms written to the log"))
+	script_log_latency.__doc__ = _("""Writes the latency of speech and braille from the remote computer by stage to the NVDA log""")
+
 	def on_connected_as_master(self):
 		self.mute_item.Enable(True)
 		self.callback_manager.call_callbacks('transport_connect', connection_type='master', transport=self.master_transport)
@@ -232,6 +329,9 @@ class GlobalPlugin(GlobalPlugin):
 		ui.message(_("Connected in client mode!"), speechPriority=speech.priorities.Spri.NOW)
 		beep_sequence.beep_sequence_async((440, 60), (660, 60))
 
+	def on_client_joined_as_master(self, **kwargs):
+		self.evaluate_remote_shell()
+
 	def on_disconnected_as_master(self):
 		# Translators: Presented when connection to a remote computer was interupted.
 		ui.message(_("Connection as client interrupted"), speechPriority=speech.priorities.Spri.NOW)
@@ -239,6 +339,8 @@ class GlobalPlugin(GlobalPlugin):
 	def on_connected_as_slave(self):
 		log.info("Connected DVC in server mode")
 		self.callback_manager.call_callbacks('transport_connect', connection_type='slave', transport=self.slave_transport)
+		if conf['unicorn']['prepareSecureDesktop'] and not globalVars.appArgs.secure:
+			self.open_secure_desktop_link()
 		ui.message(_("Connected in server mode!"), speechPriority=speech.priorities.Spri.NOW)
 
 	def evaluate_remote_shell(self):
@@ -343,37 +445,47 @@ class GlobalPlugin(GlobalPlugin):
 		"""function ran when entering a secure desktop."""
 		if self.slave_transport is None:
 			return
+		if self.sd_bridge is not None:
+			return
 		if not os.path.exists(self.temp_location):
 			os.makedirs(self.temp_location)
-		channel = str(uuid.uuid4())
-		self.sd_server = server.Server(port=0, password=channel, bind_host='127.0.0.1')
-		port = self.sd_server.server_socket.getsockname()[1]
-		server_thread = threading.Thread(target=self.sd_server.run)
-		server_thread.daemon = True
-		server_thread.start()
-		self.sd_relay = RelayTransport(address=('127.0.0.1', port), serializer=serializer.JSONSerializer(), channel=channel)
-		self.sd_relay.callback_manager.register_callback('msg_client_joined', self.sd_on_master_display_change)
+		if self.sd_link is None:
+			self.open_secure_desktop_link()
 		self.slave_transport.callback_manager.register_callback('msg_set_braille_info', self.sd_on_master_display_change)
-		self.sd_bridge = bridge.BridgeTransport(self.slave_transport, self.sd_relay)
-		relay_thread = threading.Thread(target=self.sd_relay.run)
-		relay_thread.daemon = True
-		relay_thread.start()
-		data = [port, channel]
+		self.sd_bridge = bridge.BridgeTransport(self.slave_transport, self.sd_link, raw=True)
+		data = [self.sd_link.address[1], self.sd_link.token]
 		with open(self.ipc_file, 'w') as fp:
 			json.dump(data, fp)
 
 	def leave_secure_desktop(self):
-		if self.sd_server is None:
+		if self.sd_bridge is None:
 			return #Nothing to do
 		self.sd_bridge.disconnect()
 		self.sd_bridge = None
-		self.sd_server.close()
-		self.sd_server = None
-		self.sd_relay.close()
-		self.sd_relay = None
 		self.slave_transport.callback_manager.unregister_callback('msg_set_braille_info', self.sd_on_master_display_change)
+		if conf['unicorn']['prepareSecureDesktop']:
+			# Keep the link ready for the next secure desktop, with a token that was never written to the IPC file
+			self.sd_link.reset(str(uuid.uuid4()))
+		else:
+			self.close_secure_desktop_link()
 		self.slave_session.set_display_size()
 
+	def open_secure_desktop_link(self):
+		"""Starts listening for the instance on the secure desktop. It is bridged to the slave transport when entering the secure desktop."""
+		if self.sd_link is not None:
+			return
+		# The instance on the secure desktop connects to a plain loopback socket, authenticated by the token
+		self.sd_link = LocalListenerTransport(serializer=serializer.JSONSerializer(), token=str(uuid.uuid4()), heartbeat=self.create_heartbeat())
+		self.sd_link.callback_manager.register_callback('msg_client_joined', self.sd_on_master_display_change)
+		self.sd_link.reconnector_thread.start()
+
+	def close_secure_desktop_link(self):
+		if self.sd_link is None:
+			return
+		self.sd_link.callback_manager.unregister_callback('msg_client_joined', self.sd_on_master_display_change)
+		self.sd_link.close()
+		self.sd_link = None
+
 	def enter_remote_shell(self):
 		if self.master_transport is None or not self.rs_focused:
 			return
@@ -383,11 +495,14 @@ class GlobalPlugin(GlobalPlugin):
 		self.set_receiving_braille(False)
 
 	def sd_on_master_display_change(self, **kwargs):
-		self.sd_relay.send(type='set_display_size', sizes=self.slave_session.master_display_sizes)
-
-	def connect_slave_relay(self, address, key):
-		transport = RelayTransport(serializer=serializer.JSONSerializer(), address=address, channel=key, connection_type='slave')
-		self.slave_session = SlaveSession(transport=transport, local_machine=self.local_machine)
+		self.sd_link.send(type='set_display_size', sizes=self.slave_session.master_display_sizes)
+
+	def connect_slave_relay(self, address, key, local=False):
+		if local:
+			transport = LocalTransport(serializer=serializer.JSONSerializer(), address=address, channel=key, connection_type='slave', prune_speech=True, reconnect_policy=self.create_reconnect_policy(), heartbeat=self.create_heartbeat())
+		else:
+			transport = RelayTransport(serializer=serializer.JSONSerializer(), address=address, channel=key, connection_type='slave', prune_speech=True, compress=conf['unicorn']['compressTraffic'], reconnect_policy=self.create_reconnect_policy(), heartbeat=self.create_heartbeat())
+		self.slave_session = SlaveSession(transport=transport, local_machine=self.local_machine, display_frame_rate=conf['unicorn']['maxBrailleFrameRate'])
 		self.slave_transport = transport
 		self.slave_transport.callback_manager.register_callback('transport_connected', self.on_connected_as_slave)
 		self.slave_transport.reconnector_thread.start()
@@ -399,14 +514,10 @@ class GlobalPlugin(GlobalPlugin):
 			with open(self.ipc_file) as fp:
 				data = json.load(fp)
 			os.unlink(self.ipc_file)
-			port, channel = data
-			test_socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-			test_socket=ssl.wrap_socket(test_socket)
-			test_socket.connect(('127.0.0.1', port))
-			test_socket.close()
-			self.connect_as_slave(('127.0.0.1', port), channel)
-		except:
-			pass
+			port, token = data
+			self.connect_slave_relay(('127.0.0.1', port), token, local=True)
+		except Exception:
+			log.debugWarning("Could not connect to the NVDA instance on the user desktop", exc_info=True)
 
 	def is_connected(self):
 		connector = self.slave_transport or self.master_transport
@@ -1,14 +1,22 @@
 class BridgeTransport:
 	"""Object to bridge two transports together,
 	passing messages to both of them.
-	We exclude transport-specific messages such as client_joined."""
+	We exclude transport-specific messages such as client_joined.
+	With raw, messages are passed on as they were received, only reading their type,
+	instead of being decoded and dispatched before being serialized again."""
 	excluded = ('client_joined', 'client_left', 'channel_joined', 'set_braille_info')
 
-	def __init__(self, t1, t2):
+	def __init__(self, t1, t2, raw=False):
 		self.t1 = t1
 		self.t2 = t2
-		t1.callback_manager.register_callback('*', self.send_to_t2)
-		t2.callback_manager.register_callback('*', self.send_to_t1)
+		self.raw = raw
+		# Forwarding only queues the message on the other transport, which is safe on the receiving thread
+		if raw:
+			t1.callback_manager.register_callback('transport_raw_message', self.forward_to_t2, thread_safe=True)
+			t2.callback_manager.register_callback('transport_raw_message', self.forward_to_t1, thread_safe=True)
+		else:
+			t1.callback_manager.register_callback('*', self.send_to_t2, thread_safe=True)
+			t2.callback_manager.register_callback('*', self.send_to_t1, thread_safe=True)
 
 	def send(self, transport, callback, *args, **kwargs):
 		if not callback.startswith('msg_'):
@@ -24,6 +32,21 @@ class BridgeTransport:
 	def send_to_t1(self, callback, *args, **kwargs):
 		self.send(self.t1, callback, *args, **kwargs)
 
+	def forward(self, transport, type, data, serializer):
+		if type in self.excluded:
+			return
+		transport.send_raw(type, data, serializer)
+
+	def forward_to_t2(self, type, data, serializer):
+		self.forward(self.t2, type, data, serializer)
+
+	def forward_to_t1(self, type, data, serializer):
+		self.forward(self.t1, type, data, serializer)
+
 	def disconnect(self):
-		self.t1.callback_manager.unregister_callback('*', self.send_to_t2)
-		self.t2.callback_manager.unregister_callback('*', self.send_to_t1)
+		if self.raw:
+			self.t1.callback_manager.unregister_callback('transport_raw_message', self.forward_to_t2)
+			self.t2.callback_manager.unregister_callback('transport_raw_message', self.forward_to_t1)
+		else:
+			self.t1.callback_manager.unregister_callback('*', self.send_to_t2)
+			self.t2.callback_manager.unregister_callback('*', self.send_to_t1)
@@ -1,31 +1,153 @@
 from logging import getLogger
 logger = getLogger('callback_manager')
+import inspect
+import threading
+import time
+import weakref
 import wx
-from collections import defaultdict
+from collections import namedtuple
+from contextlib import contextmanager
+from . import metrics
+
+Registration = namedtuple('Registration', ('ref', 'thread_safe'))
+
+
+class StrongRef:
+	"""Holds a callback with the interface of a weak reference, for callbacks that are registered strongly."""
+	__slots__ = ('callback',)
+
+	def __init__(self, callback):
+		self.callback = callback
+
+	def __call__(self):
+		return self.callback
+
+
+def create_ref(callback, weak):
+	if not weak:
+		return StrongRef(callback)
+	if inspect.ismethod(callback):
+		# A plain weak reference to a bound method dies right away, as the method object is created on access
+		return weakref.WeakMethod(callback)
+	return weakref.ref(callback)
+
 
 class CallbackManager:
-	"""A simple way of associating multiple callbacks to events and calling them all when that event happens"""
+	"""A simple way of associating multiple callbacks to events and calling them all when that event happens.
+	Callbacks are called on the main thread, except those registered as thread safe,
+	which are called right away on the thread calling the callbacks."""
 
 	def __init__(self):
-		self.callbacks = defaultdict(list)
+		# Tuples of registrations by event type. A tuple is replaced rather than changed,
+		# so callbacks can be called from any thread while others register and unregister
+		self.callbacks = {}
+		self.lock = threading.Lock()
+		# Calls collected by a batch on the current thread
+		self.batch_state = threading.local()
+		self.metrics = metrics.CallbackMetrics()
 
-	def register_callback(self, event_type, callback):
-		"""Registers a callback as a callable to an event type, which can be anything hashable"""
-		self.callbacks[event_type].append(callback)
+	def register_callback(self, event_type, callback, thread_safe=False, weak=False):
+		"""Registers a callback as a callable to an event type, which can be anything hashable.
+		With weak, the callback does not keep its object alive, and is unregistered once the object is gone."""
+		registration = Registration(create_ref(callback, weak), thread_safe)
+		with self.lock:
+			registrations = self.callbacks.get(event_type, ())
+			self.callbacks[event_type] = tuple(r for r in registrations if r.ref() is not None) + (registration, )
 
 	def unregister_callback(self, event_type, callback):
 		"""Unregisters a callback from an event type"""
-		self.callbacks[event_type].remove(callback)
+		with self.lock:
+			registrations = self.callbacks.get(event_type, ())
+			for index, registration in enumerate(registrations):
+				if registration.ref() == callback:
+					self.set_registrations(event_type, registrations[:index] + registrations[index + 1:])
+					return
+		raise ValueError(f"{callback!r} is not registered for {event_type!r}")
+
+	def set_registrations(self, event_type, registrations):
+		if registrations:
+			self.callbacks[event_type] = registrations
+		else:
+			self.callbacks.pop(event_type, None)
+
+	def prune(self, event_type):
+		"""Removes the weakly registered callbacks of event_type whose object is gone."""
+		with self.lock:
+			registrations = self.callbacks.get(event_type, ())
+			self.set_registrations(event_type, tuple(r for r in registrations if r.ref() is not None))
+
+	def has_callbacks(self, event_type, include_all=True):
+		"""Returns whether calling event_type calls any callback, including those registered to all events unless include_all is False."""
+		return bool(self.callbacks.get(event_type) or (include_all and self.callbacks.get('*')))
+
+	def registration_counts(self):
+		"""Returns the number of callbacks registered to each event type, to spot registrations that are never removed."""
+		callbacks = self.callbacks.copy()
+		counts = {}
+		for event_type, registrations in callbacks.items():
+			count = sum(1 for r in registrations if r.ref() is not None)
+			if count:
+				counts[event_type] = count
+		return counts
+
+	@contextmanager
+	def batch(self):
+		"""Delivers the callbacks of all events called on this thread within the block to the main thread at once."""
+		if getattr(self.batch_state, 'calls', None) is not None:
+			# Nested batch, the outer one delivers the calls
+			yield
+			return
+		self.batch_state.calls = calls = []
+		try:
+			yield
+		finally:
+			self.batch_state.calls = None
+			if calls:
+				wx.CallAfter(self.run_calls, calls, time.perf_counter())
 
 	def call_callbacks(self, type, *args, **kwargs):
 		"""Calls all callbacks for a given event type with the provided args and kwargs"""
-		for callback in self.callbacks[type]:
-			try:
-				wx.CallAfter(callback, *args, **kwargs)
-			except Exception as e:
-				logger.exception("Error calling callback %r" % callback)
-		for callback in self.callbacks['*']:
+		self.metrics.event_called(type)
+		calls = []
+		direct_calls = []
+		for event_type, event_args in ((type, args), ('*', (type, ) + args)):
+			dead = False
+			for registration in self.callbacks.get(event_type, ()):
+				callback = registration.ref()
+				if callback is None:
+					dead = True
+				elif registration.thread_safe:
+					direct_calls.append((callback, event_args, kwargs))
+				else:
+					calls.append((callback, event_args, kwargs))
+			if dead:
+				self.prune(event_type)
+		if calls:
+			batch_calls = getattr(self.batch_state, 'calls', None)
+			if batch_calls is not None:
+				batch_calls.extend(calls)
+			else:
+				wx.CallAfter(self.run_calls, calls, time.perf_counter())
+		if direct_calls:
+			self.run_calls(direct_calls)
+
+	def run_calls(self, calls, queued=None):
+		"""Runs the calls, which were queued for the main thread at the perf_counter time queued, if given."""
+		metrics = self.metrics
+		start = time.perf_counter()
+		if queued is not None:
+			wait = start - queued
+			metrics.waits += 1
+			metrics.wait_time += wait
+			metrics.max_wait_time = max(metrics.max_wait_time, wait)
+		for callback, args, kwargs in calls:
 			try:
-				wx.CallAfter(callback, type, *args, **kwargs)
-			except Exception as e:
+				callback(*args, **kwargs)
+			except Exception:
+				metrics.errors += 1
 				logger.exception("Error calling callback %r" % callback)
+			end = time.perf_counter()
+			metrics.calls += 1
+			metrics.call_time += end - start
+			metrics.max_call_time = max(metrics.max_call_time, end - start)
+			start = end
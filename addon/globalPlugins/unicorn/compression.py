@@ -0,0 +1,93 @@
+"""Streaming compression of the data sent over a connection.
+One compressor and one decompressor are kept for the lifetime of a connection,
+so repeated speech and braille content compresses against everything sent before."""
+
+import zlib
+
+ZLIB = 'zlib'
+# Compression methods that can be negotiated with the remote end, by order of preference
+METHODS = (ZLIB,)
+
+
+class Compressor:
+
+	def __init__(self, level=6):
+		self.compressobj = zlib.compressobj(level)
+
+	def compress(self, data):
+		"""Compresses data, which may be held back until the next flush."""
+		return self.compressobj.compress(data)
+
+	def flush(self):
+		"""Returns all held back data, ending on a byte boundary the remote end can decompress up to."""
+		return self.compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+	def compress_batch(self, data):
+		return self.compressobj.compress(data) + self.compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Decompressor:
+
+	def __init__(self):
+		self.decompressobj = zlib.decompressobj()
+
+	def decompress_chunks(self, data, chunk_size):
+		"""Yields the data decompressed so far in pieces of at most chunk_size bytes.
+		Each piece is only decompressed once the previous one was taken,
+		so the receiver can give up on data that inflates too much. Raises ValueError on corrupt data."""
+		try:
+			chunk = self.decompressobj.decompress(data, chunk_size)
+			while chunk:
+				yield chunk
+				# Output may be pending even when all input was consumed, so this only ends on an empty piece
+				chunk = self.decompressobj.decompress(self.decompressobj.unconsumed_tail, chunk_size)
+		except zlib.error as e:
+			raise ValueError(f"Invalid compressed data: {e}") from e
+
+
+class ReceiveStream:
+	"""Splits the data received over a connection into messages with framer.
+	The other end announces with a message that it compresses everything after it,
+	from then on the data is decompressed, including what was received along with that message.
+	Data is decompressed up to the maximum message size of framer at a time,
+	so a message inflating beyond it is rejected before the rest of it is decompressed."""
+
+	def __init__(self, framer):
+		self.framer = framer
+		self.decompressor = None
+		# Received data that has not been decompressed yet
+		self.compressed = b''
+
+	def feed(self, data):
+		if self.decompressor is None:
+			self.framer.feed(data)
+		else:
+			self.compressed += data
+
+	def __iter__(self):
+		"""Yields the complete messages received. Raises ValueError on corrupt data and on messages that are too large."""
+		yield from self.framer
+		# Decompression may start while the messages before are handled
+		while self.compressed:
+			data, self.compressed = self.compressed, b''
+			for chunk in self.decompressor.decompress_chunks(data, self.framer.max_message_size):
+				self.framer.feed(chunk)
+				yield from self.framer
+
+	def start_decompression(self, method, methods):
+		"""Decompresses the data after the message being handled, which switched to method.
+		Raises ValueError when method is not one of methods or when the data is already decompressed."""
+		if method not in methods or self.decompressor is not None:
+			raise ValueError(f"Unexpected switch to compression method {method!r}")
+		self.decompressor = Decompressor()
+		self.compressed = self.framer.take_remaining()
+
+	def clear(self):
+		self.framer.clear()
+		self.decompressor = None
+		self.compressed = b''
+
+
+def negotiate(local_methods, remote_methods):
+	"""Returns the most preferred compression method both ends support, or None."""
+	return next((method for method in local_methods if method in remote_methods), None)
@@ -1,4 +1,25 @@
 configSpec = {
 	'autoConnectClient': 'boolean(default=False)',
 	'autoConnectServer': 'boolean(default=False)',
+	# Maximum number of braille display updates per second sent to the client
+	'maxBrailleFrameRate': 'integer(default=20, min=1, max=100)',
+	# Compress the traffic of connections when the other end supports it
+	'compressTraffic': 'boolean(default=True)',
+	# Listen for the NVDA instance on the secure desktop as soon as connected in server mode,
+	# instead of when the secure desktop is entered
+	'prepareSecureDesktop': 'boolean(default=True)',
+	# Seconds between pings, and number of unanswered pings after which the other end is considered dead
+	'heartbeatInterval': 'float(default=2, min=0.5, max=60)',
+	'maxMissedPongs': 'integer(default=3, min=1, max=20)',
+	# Seconds to wait before reconnecting, doubled after every failed attempt up to the maximum,
+	# and shortened by a random part of up to the jitter fraction.
+	# A connection that lasted the stable time reconnects without waiting
+	'reconnectInitialDelay': 'float(default=0.5, min=0.1, max=60)',
+	'reconnectMaxDelay': 'float(default=30, min=1, max=600)',
+	'reconnectJitter': 'float(default=0.5, min=0, max=1)',
+	'reconnectStableTime': 'float(default=10, min=0, max=600)',
+	# Stamp speech and braille with the time they pass each stage, to log the latency of each stage
+	'traceLatency': 'boolean(default=False)',
+	# Seconds between log lines with the metrics of the connections, 0 to only log them on request
+	'metricsLogInterval': 'integer(default=600, min=0, max=86400)',
 }
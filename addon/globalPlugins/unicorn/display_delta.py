@@ -0,0 +1,44 @@
+"""Compact encoding of braille display frames as changes relative to the previous frame.
+A frame is sent as a list of runs, each run being the offset of its first cell
+and the base64 encoded bytes of the cells from that offset onwards."""
+
+import base64
+
+# Unchanged cells between two changes that are still sent as part of one run,
+# since they take less space than starting a new run
+MAX_GAP = 4
+
+
+def encode_run(offset, cells):
+	return [offset, base64.b64encode(bytes(cells)).decode('ascii')]
+
+
+def keyframe(cells):
+	"""Returns the runs that encode a complete frame."""
+	return [encode_run(0, cells)]
+
+
+def diff(previous, cells):
+	"""Returns the runs that turn the previous frame into cells. Both frames must be equally long."""
+	runs = []
+	start = end = None
+	for index, (old, new) in enumerate(zip(previous, cells)):
+		if old == new:
+			continue
+		if start is None:
+			start = index
+		elif index - end > MAX_GAP:
+			runs.append(encode_run(start, cells[start:end]))
+			start = index
+		end = index + 1
+	if start is not None:
+		runs.append(encode_run(start, cells[start:end]))
+	return runs
+
+
+def apply(cells, runs):
+	"""Applies runs to the list of cells in place."""
+	for offset, data in runs:
+		data = base64.b64decode(data)
+		cells[offset:offset + len(data)] = data
+	return cells
@@ -0,0 +1,171 @@
+"""Incremental framing of received data into messages."""
+
+from collections import deque
+import struct
+
+DEFAULT_MAX_MESSAGE_SIZE = 2 ** 20
+
+
+class MessageTooLargeError(ValueError):
+	"""Raised when a message exceeds the maximum message size of a framer."""
+
+
+class LineFramer:
+	"""Splits a byte stream into newline separated messages.
+	Data is only copied when it is received and when a complete line is taken out,
+	and every byte is scanned for the separator once, regardless of how the stream is chunked.
+	Lines are returned as bytes, so multi-byte characters split between reads are decoded intact."""
+	SEP = b'\n'
+
+	def __init__(self, max_message_size=DEFAULT_MAX_MESSAGE_SIZE):
+		self.max_message_size = max_message_size
+		self.buffer = bytearray()
+		# Offset of the first byte that has not been returned as part of a line
+		self.start = 0
+		# Offset from where to search for the next separator
+		self.scan_pos = 0
+
+	def feed(self, data):
+		"""Adds received data to the buffer."""
+		self.compact()
+		self.buffer += data
+
+	def __iter__(self):
+		"""Yields the complete lines in the buffer, without separator.
+		Lines that are not consumed stay in the buffer."""
+		buffer = self.buffer
+		sep = self.SEP
+		try:
+			while True:
+				index = buffer.find(sep, self.scan_pos)
+				if index == -1:
+					self.scan_pos = len(buffer)
+					if self.scan_pos - self.start > self.max_message_size:
+						raise MessageTooLargeError("Message exceeds %d bytes" % self.max_message_size)
+					return
+				if index - self.start > self.max_message_size:
+					raise MessageTooLargeError("Message exceeds %d bytes" % self.max_message_size)
+				line = bytes(buffer[self.start:index])
+				self.start = self.scan_pos = index + len(sep)
+				yield line
+		finally:
+			self.compact()
+
+	def compact(self):
+		if self.start:
+			del self.buffer[:self.start]
+			self.scan_pos -= self.start
+			self.start = 0
+
+	def take_remaining(self):
+		"""Removes and returns the data that has not been returned as part of a line.
+		Can be called while iterating, when the data after a line is encoded differently, such as compressed."""
+		remaining = bytes(self.buffer[self.start:])
+		del self.buffer[self.start:]
+		self.scan_pos = self.start
+		return remaining
+
+	def clear(self):
+		self.buffer.clear()
+		self.start = self.scan_pos = 0
+
+
+class TextLineFramer:
+	"""Splits a stream of text into newline separated messages.
+	Every received chunk is searched for the separator once, and an incomplete line is only joined when it is complete."""
+	SEP = '\n'
+
+	def __init__(self, max_message_size=DEFAULT_MAX_MESSAGE_SIZE):
+		self.max_message_size = max_message_size
+		self.chunks = deque()
+		# Offset in the first chunk of the first character that has not been returned
+		self.pos = 0
+		# Pieces of the incomplete line
+		self.parts = []
+		self.parts_size = 0
+
+	def feed(self, data):
+		"""Adds received text to the buffer."""
+		if data:
+			self.chunks.append(data)
+
+	def __iter__(self):
+		"""Yields the complete lines in the buffer, without separator.
+		Lines that are not consumed stay in the buffer."""
+		chunks = self.chunks
+		sep = self.SEP
+		while chunks:
+			chunk = chunks[0]
+			index = chunk.find(sep, self.pos)
+			if index == -1:
+				self.parts.append(chunk[self.pos:] if self.pos else chunk)
+				self.parts_size += len(chunk) - self.pos
+				chunks.popleft()
+				self.pos = 0
+				if self.parts_size > self.max_message_size:
+					raise MessageTooLargeError("Message exceeds %d characters" % self.max_message_size)
+				continue
+			if self.parts_size + index - self.pos > self.max_message_size:
+				raise MessageTooLargeError("Message exceeds %d characters" % self.max_message_size)
+			if self.parts:
+				self.parts.append(chunk[self.pos:index])
+				line = "".join(self.parts)
+				self.parts.clear()
+				self.parts_size = 0
+			else:
+				line = chunk[self.pos:index]
+			self.pos = index + len(sep)
+			if self.pos == len(chunk):
+				chunks.popleft()
+				self.pos = 0
+			yield line
+
+	def clear(self):
+		self.chunks.clear()
+		self.parts.clear()
+		self.pos = self.parts_size = 0
+
+
+class LengthPrefixFramer:
+	"""Splits a byte stream into messages that are each prefixed with their length as a 4 byte big endian integer."""
+	LENGTH = struct.Struct('>I')
+
+	def __init__(self, max_message_size=DEFAULT_MAX_MESSAGE_SIZE):
+		self.max_message_size = max_message_size
+		self.buffer = bytearray()
+		# Offset of the length prefix of the first message that has not been returned
+		self.start = 0
+
+	def feed(self, data):
+		"""Adds received data to the buffer."""
+		self.compact()
+		self.buffer += data
+
+	def __iter__(self):
+		"""Yields the complete messages in the buffer, without length prefix.
+		Messages that are not consumed stay in the buffer."""
+		buffer = self.buffer
+		prefix_size = self.LENGTH.size
+		try:
+			while len(buffer) - self.start >= prefix_size:
+				length = self.LENGTH.unpack_from(buffer, self.start)[0]
+				if length > self.max_message_size:
+					raise MessageTooLargeError("Message exceeds %d bytes" % self.max_message_size)
+				begin = self.start + prefix_size
+				end = begin + length
+				if end > len(buffer):
+					return
+				message = bytes(buffer[begin:end])
+				self.start = end
+				yield message
+		finally:
+			self.compact()
+
+	def compact(self):
+		if self.start:
+			del self.buffer[:self.start]
+			self.start = 0
+
+	def clear(self):
+		self.buffer.clear()
+		self.start = 0
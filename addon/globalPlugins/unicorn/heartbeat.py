@@ -0,0 +1,102 @@
+"""Liveness checks and round trip time measurement of a connection.
+A ping carries the time it was sent at, the other end answers with a pong carrying the same time,
+so the round trip time is measured with the clock of the sender only.
+Pongs also carry the wall clock time of the answering end, from which the offset between both clocks is estimated."""
+
+import threading
+import time
+from collections import deque
+from logHandler import log
+
+# Message types of the heartbeat, which are answered by the transport and never dispatched or forwarded
+MESSAGES = ('ping', 'pong')
+
+
+class Heartbeat:
+	"""Sends a ping every interval seconds and keeps a smoothed round trip time and jitter from the pongs,
+	computed like TCP does for its retransmission timer (RFC 6298).
+	Once the other end answered a ping, it is considered dead when max_missed pings in a row are not answered.
+	Other ends that never answer, such as older versions, are not checked."""
+	# Gains of the smoothed round trip time and of its mean deviation
+	RTT_GAIN = 1 / 8
+	JITTER_GAIN = 1 / 4
+	# Number of recent pongs among which the one with the lowest round trip time gives the clock offset,
+	# since the less time a pong was queued, the less its estimate is off
+	CLOCK_SAMPLES = 8
+
+	def __init__(self, interval=2, max_missed=3):
+		self.interval = interval
+		self.max_missed = max_missed
+		self.lock = threading.Lock()
+		self.stop_event = None
+		self.reset()
+
+	def reset(self):
+		# Send times of the pings that have not been answered, oldest first
+		self.pending = []
+		self.answered = False
+		self.rtt = None
+		self.jitter = None
+		self.last_rtt = None
+		# (round trip time, clock offset) of recent pongs carrying the clock of the other end
+		self.clock_samples = deque(maxlen=self.CLOCK_SAMPLES)
+		self.clock_offset = None
+
+	def start(self, send, on_dead):
+		"""Starts sending pings with send(type, **kwargs). on_dead is called on the heartbeat thread when the other end is dead."""
+		self.stop()
+		with self.lock:
+			self.reset()
+		self.stop_event = threading.Event()
+		thread = threading.Thread(target=self.run, args=(send, on_dead, self.stop_event), name="heartbeat")
+		thread.daemon = True
+		thread.start()
+
+	def stop(self):
+		"""Stops sending pings. Doesn't wait for the heartbeat thread, which may be the calling thread."""
+		if self.stop_event is not None:
+			self.stop_event.set()
+			self.stop_event = None
+
+	def run(self, send, on_dead, stop_event):
+		# The first ping waits as well, so that the messages that set up the connection go first
+		while not stop_event.wait(self.interval):
+			with self.lock:
+				dead = self.answered and len(self.pending) >= self.max_missed
+				if not dead:
+					sent = time.monotonic()
+					self.pending.append(sent)
+					# Pings of other ends that never answer are not kept forever
+					del self.pending[:-self.max_missed]
+			if dead:
+				log.warning(f"No answer to {self.max_missed} pings, the other end is considered dead")
+				on_dead()
+				return
+			send('ping', time=sent)
+
+	def pong_received(self, sent, clock=None):
+		"""Updates the round trip time estimates with the answer to the ping sent at sent.
+		clock is the wall clock time of the other end when it answered, if it sent it.
+		Pongs answering pings of other clients, which a relay may pass on, are ignored."""
+		now = time.monotonic()
+		wall_now = time.time()
+		with self.lock:
+			try:
+				index = self.pending.index(sent)
+			except ValueError:
+				return
+			# Earlier pings that are still pending were lost, not answered late
+			del self.pending[:index + 1]
+			self.answered = True
+			rtt = now - sent
+			self.last_rtt = rtt
+			if self.rtt is None:
+				self.rtt = rtt
+				self.jitter = rtt / 2
+			else:
+				self.jitter += self.JITTER_GAIN * (abs(self.rtt - rtt) - self.jitter)
+				self.rtt += self.RTT_GAIN * (rtt - self.rtt)
+			if isinstance(clock, (int, float)):
+				# The other end answered about half a round trip ago
+				self.clock_samples.append((rtt, clock - (wall_now - rtt / 2)))
+				self.clock_offset = min(self.clock_samples)[1]
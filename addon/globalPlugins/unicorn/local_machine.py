@@ -1,6 +1,8 @@
 import os
 import wx
 from . import input
+from . import display_delta
+from . import tracing
 import speech
 import braille
 import inputCore
@@ -13,6 +15,8 @@ class LocalMachine:
 	def __init__(self):
 		self.is_muted = False
 		self.receiving_braille = False
+		# Maps the origin of display deltas to the id and cells of the last frame received from it
+		self.display_frames = {}
 
 	def play_wave(self, fileName, asynchronous=True, **kwargs):
 		if self.is_muted:
@@ -32,18 +36,36 @@ class LocalMachine:
 			return
 		wx.CallAfter(speech._manager.cancel)
 
-	def speak(self, sequence, priority=speech.priorities.Spri.NORMAL, **kwargs):
+	def speak(self, sequence, priority=speech.priorities.Spri.NORMAL, trace=None, **kwargs):
 		if self.is_muted:
 			return
+		tracing.tracer.finish('speak', trace)
 		speech.beenCanceled = False
 		wx.CallAfter(speech._manager.speak, sequence, priority)
 
-	def display(self, cells, **kwargs):
+	def display(self, cells, trace=None, **kwargs):
 		if self.receiving_braille and braille.handler.displaySize > 0 and len(cells) <= braille.handler.displaySize:
+			tracing.tracer.finish('display', trace)
 			# We use braille.handler._writeCells since this respects thread safe displays and automatically falls back to noBraille if desired
 			cells = cells + [0] * (braille.handler.displaySize - len(cells))
 			wx.CallAfter(braille.handler._writeCells, cells)
 
+	def display_delta(self, frame, base, size, runs, origin=None, trace=None, **kwargs):
+		"""Applies a frame encoded as changes to the previous frame from the same origin and displays it.
+		Returns False when the previous frame is unknown, in which case a keyframe is needed."""
+		if base is None:
+			cells = [0] * size
+		else:
+			previous = self.display_frames.get(origin)
+			if previous is None or previous[0] != base or len(previous[1]) != size:
+				self.display_frames.pop(origin, None)
+				return False
+			cells = previous[1]
+		display_delta.apply(cells, runs)
+		self.display_frames[origin] = (frame, cells)
+		self.display(cells, trace=trace)
+		return True
+
 	def braille_input(self, **kwargs):
 		try:
 			inputCore.manager.executeGesture(input.BrailleInputGesture(**kwargs))
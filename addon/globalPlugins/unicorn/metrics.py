@@ -0,0 +1,87 @@
+"""Runtime counters of transports and callback managers, to see how much traffic a link carries and where time goes.
+Counters are updated without locking, each mostly from a single thread, which is exact enough for monitoring.
+Dictionaries of counters are read from snapshots, since other threads may add keys meanwhile.
+Message sizes are those of the serialized messages, in characters for text serializers and in bytes for binary ones.
+Wire sizes are those of the data actually written and read, after compression."""
+
+
+class MessageCounts:
+	"""Number and total size of messages by message type."""
+
+	def __init__(self):
+		self.by_type = {}
+
+	def add(self, type, size):
+		counts = self.by_type.get(type)
+		if counts is None:
+			counts = self.by_type[type] = [0, 0]
+		counts[0] += 1
+		counts[1] += size
+
+	def snapshot(self):
+		"""Returns (type, messages, size) tuples."""
+		return [(type, counts[0], counts[1]) for type, counts in list(self.by_type.items())]
+
+	@property
+	def messages(self):
+		return sum(messages for type, messages, size in self.snapshot())
+
+	@property
+	def size(self):
+		return sum(size for type, messages, size in self.snapshot())
+
+	def __str__(self):
+		by_type = sorted(self.snapshot(), key=lambda item: item[2], reverse=True)
+		types = ", ".join(f"{type}: {messages}/{size}" for type, messages, size in by_type)
+		messages = sum(item[1] for item in by_type)
+		size = sum(item[2] for item in by_type)
+		return f"{messages} messages of {size} in total ({types or 'none'})"
+
+
+class TransportMetrics:
+
+	def __init__(self):
+		self.sent = MessageCounts()
+		self.received = MessageCounts()
+		self.written = 0
+		self.read = 0
+		# Messages sent while disconnected, or still queued when the connection ended.
+		# Speech pruned from the send queue is counted by the queue
+		self.dropped = 0
+		self.connection_attempts = 0
+		# Connections that ended, whether lost or closed
+		self.disconnects = 0
+		# Seconds spent serializing and deserializing messages
+		self.serialize_time = 0
+		self.deserialize_time = 0
+
+
+class CallbackMetrics:
+
+	def __init__(self):
+		# Number of times each event was called
+		self.events = {}
+		self.calls = 0
+		self.errors = 0
+		# Seconds spent in callbacks
+		self.call_time = 0
+		self.max_call_time = 0
+		# Seconds callbacks queued for the main thread waited before running
+		self.waits = 0
+		self.wait_time = 0
+		self.max_wait_time = 0
+
+	def event_called(self, type):
+		self.events[type] = self.events.get(type, 0) + 1
+
+	def __str__(self):
+		event_counts = dict(self.events)
+		events = sum(event_counts.values())
+		busiest = ", ".join(f"{type}: {count}" for type, count in sorted(event_counts.items(), key=lambda item: item[1], reverse=True)[:5])
+		mean_call = self.call_time / self.calls * 1e3 if self.calls else 0
+		mean_wait = self.wait_time / self.waits * 1e3 if self.waits else 0
+		return (
+			f"{events} events ({busiest or 'none'}), {self.calls} callbacks run in {self.call_time:.3f} s, "
+			f"mean {mean_call:.3f} ms, max {self.max_call_time * 1e3:.1f} ms, {self.errors} errors, "
+			f"main thread wait mean {mean_wait:.3f} ms, max {self.max_wait_time * 1e3:.1f} ms"
+		)
@@ -1,4 +1,5 @@
 from . import callback_manager
+from . import tracing
 import synthDriverHandler
 import tones
 import nvwave
@@ -123,7 +124,7 @@ class NVDASlavePatcher(NVDAPatcher):
 		self.unpatch_braille()
 
 	def speak(self, speechSequence, priority):
-		self.call_callbacks('speak', speechSequence=speechSequence, priority=priority)
+		self.call_callbacks('speak', speechSequence=speechSequence, priority=priority, trace=tracing.tracer.start())
 		self.orig_speak(speechSequence, priority)
 
 	def cancel(self):
@@ -137,7 +138,7 @@ class NVDASlavePatcher(NVDAPatcher):
 		self.call_callbacks('wave', fileName=fileName, asynchronous=asynchronous)
 
 	def display(self, cells):
-		self.call_callbacks('display', cells=cells)
+		self.call_callbacks('display', cells=cells, trace=tracing.tracer.start())
 		self.orig_display(cells)
 
 class NVDAMasterPatcher(NVDAPatcher):
@@ -1,57 +1,318 @@
 import sys
 import os
 import json
+import struct
 import speech.commands
+from logHandler import log
 
 class JSONSerializer:
+	name = 'json'
+	binary = False
 	SEP = '\n'
+	TYPE_PREFIX = '{"type": "'
 
 	def serialize(self, type=None, **obj):
-		obj['type'] = type
-		data = json.dumps(obj, cls=CustomEncoder) + self.SEP
+		# The type comes first, so it can be read without decoding the whole message
+		obj = dict(type=type, **obj)
+		data = json_encoder.encode(obj) + self.SEP
 		return data
 
 	def deserialize(self, data):
-		obj = json.loads(data, object_hook=as_sequence)
+		obj = json.loads(data)
+		if not isinstance(obj, dict):
+			raise ValueError("Message is not an object")
+		decode_speech(obj)
 		return obj
 
+	def peek_type(self, data):
+		"""Returns the type of a serialized message, only decoding the whole message when the type doesn't come first."""
+		prefix = self.TYPE_PREFIX
+		if data.startswith(prefix):
+			end = data.find('"', len(prefix))
+			if end != -1 and '\\' not in data[len(prefix):end]:
+				return data[len(prefix):end]
+		return self.deserialize(data).get('type')
+
+	def frame(self, data):
+		"""Returns a message as it was received, without separator, ready to be sent."""
+		return data + self.SEP
+
 
 SEQUENCE_CLASSES = (
 	speech.commands.SynthCommand,
 	speech.commands.EndUtteranceCommand,
 )
 
-class CustomEncoder(json.JSONEncoder):
-
-	def default(self, obj):
-		if is_subclass_or_instance(obj, SEQUENCE_CLASSES):
-			return [obj.__class__.__name__, obj.__dict__]
-		return super().default(obj)
-
-def is_subclass_or_instance(unknown, possible):
-	try:
-		return issubclass(unknown, possible)
-	except TypeError:
-		return isinstance(unknown, possible)
-
-def as_sequence(dct):
-	if not ('type' in dct and dct['type'] == 'speak' and 'sequence' in dct):
-		return dct
-	sequence = []
-	for item in dct['sequence']:
-		if not isinstance(item, list):
-			sequence.append(item)
-			continue
-		name, values = item
-		if not hasattr(speech.commands, name):
-			log.warning("Unknown sequence type received: %r" % name)
-			continue
-		cls = getattr(speech, name)
-		if not issubclass(cls, SEQUENCE_CLASSES):
-			log.warning(f"Unknown sequence type received: {name!r}")
-			continue
-		cls = cls.__new__(cls)
-		cls.__dict__.update(values)
-		sequence.append(cls)
-	dct['sequence'] = sequence
-	return dct
+
+class SpeechCommandCodec:
+	"""Converts speech commands to and from [class name, attributes] lists.
+	The table of command classes is built once from speech.commands,
+	so encoding and decoding a command is a dictionary lookup."""
+
+	def __init__(self, module=speech.commands, base_classes=SEQUENCE_CLASSES):
+		self.encoders = {}
+		self.decoders = {}
+		for name, cls in vars(module).items():
+			if isinstance(cls, type) and issubclass(cls, base_classes):
+				self.encoders[cls] = self.create_encoder(name)
+				self.decoders[name] = self.create_decoder(cls)
+
+	@staticmethod
+	def create_encoder(name):
+		def encode(command):
+			return [name, command.__dict__]
+		return encode
+
+	@staticmethod
+	def create_decoder(cls):
+		def decode(values):
+			command = cls.__new__(cls)
+			command.__dict__.update(values)
+			return command
+		return decode
+
+	def encode(self, command):
+		encoder = self.encoders.get(command.__class__)
+		if encoder is not None:
+			return encoder(command)
+		if isinstance(command, SEQUENCE_CLASSES):
+			# A command class defined outside speech.commands, which the remote end might know about
+			return [command.__class__.__name__, command.__dict__]
+		raise TypeError(f"Object of type {command.__class__.__name__} can not be serialized")
+
+	def decode_sequence(self, sequence):
+		"""Returns sequence with the encoded commands replaced by commands. Unknown commands are left out."""
+		for item in sequence:
+			if item.__class__ is not str:
+				break
+		else:
+			# Sequences of text only, such as during say all, need no decoding
+			return sequence
+		decoded = []
+		for item in sequence:
+			if item.__class__ is not list:
+				decoded.append(item)
+				continue
+			name, values = item
+			decoder = self.decoders.get(name)
+			if decoder is None:
+				log.warning(f"Unknown sequence type received: {name!r}")
+				continue
+			decoded.append(decoder(values))
+		return decoded
+
+
+speech_commands = SpeechCommandCodec()
+json_encoder = json.JSONEncoder(default=speech_commands.encode)
+
+
+def decode_speech(obj):
+	"""Decodes the speech commands of a deserialized speak message in place. Other messages are left alone."""
+	if obj.get('type') == 'speak' and 'sequence' in obj:
+		try:
+			obj['sequence'] = speech_commands.decode_sequence(obj['sequence'])
+		except TypeError as e:
+			raise ValueError(f"Invalid speech sequence: {e}") from e
+
+
+class BinarySerializer:
+	"""Serializes messages to a MessagePack compatible binary format, prefixed with the length of the message.
+	Speech commands are encoded as [class name, attributes] arrays, like the JSON serializer does."""
+	name = 'binary'
+	binary = True
+	LENGTH = struct.Struct('>I')
+
+	def serialize(self, type=None, **obj):
+		obj = dict(type=type, **obj)
+		data = bytearray(self.LENGTH.size)
+		pack(obj, data)
+		self.LENGTH.pack_into(data, 0, len(data) - self.LENGTH.size)
+		return bytes(data)
+
+	def deserialize(self, data):
+		"""Deserializes a single message, without the length prefix. Raises ValueError on truncated or corrupt data."""
+		obj, offset = self.unpack(data, 0)
+		if offset > len(data):
+			raise ValueError("Truncated message")
+		if offset != len(data):
+			raise ValueError("Trailing data after message")
+		if not isinstance(obj, dict):
+			raise ValueError("Message is not a map")
+		decode_speech(obj)
+		return obj
+
+	def peek_type(self, data):
+		"""Returns the type of a serialized message, only decoding the whole message when the type doesn't come first."""
+		if not data:
+			raise ValueError("Empty message")
+		tag = data[0]
+		offset = 1 if 0x80 <= tag <= 0x8f else 3 if tag == 0xde else 5 if tag == 0xdf else None
+		if offset is not None:
+			key, offset = self.unpack(data, offset)
+			if key == 'type':
+				type, offset = self.unpack(data, offset)
+				if offset > len(data):
+					raise ValueError("Truncated message")
+				return type
+		return self.deserialize(data).get('type')
+
+	@staticmethod
+	def unpack(data, offset):
+		"""Like unpack, raising ValueError on truncated or corrupt data rather than whatever the decoding ran into."""
+		try:
+			return unpack(data, offset)
+		except (IndexError, TypeError, struct.error, RecursionError) as e:
+			raise ValueError(f"Invalid message: {e}") from e
+
+	def frame(self, data):
+		"""Returns a message as it was received, without length prefix, ready to be sent."""
+		return self.LENGTH.pack(len(data)) + data
+
+
+# Serializers that can be negotiated with the remote end, by order of preference.
+# JSON is encoded and decoded about twice as fast, binary messages are smaller, which compression mostly makes up for
+SERIALIZERS = {cls.name: cls for cls in (JSONSerializer, BinarySerializer)}
+
+_uint16 = struct.Struct('>H')
+_uint32 = struct.Struct('>I')
+_int64 = struct.Struct('>q')
+_float64 = struct.Struct('>d')
+
+
+def _pack_length(length, fix_tag, fix_max, tag8, tag16, tag32, data):
+	if length <= fix_max:
+		data.append(fix_tag | length)
+	elif tag8 is not None and length < 0x100:
+		data.append(tag8)
+		data.append(length)
+	elif length < 0x10000:
+		data.append(tag16)
+		data += _uint16.pack(length)
+	else:
+		data.append(tag32)
+		data += _uint32.pack(length)
+
+
+def pack(obj, data):
+	"""Appends obj to the bytearray data."""
+	if isinstance(obj, str):
+		encoded = obj.encode('utf-8', 'surrogatepass')
+		_pack_length(len(encoded), 0xa0, 31, 0xd9, 0xda, 0xdb, data)
+		data += encoded
+	elif obj is None:
+		data.append(0xc0)
+	elif obj is True:
+		data.append(0xc3)
+	elif obj is False:
+		data.append(0xc2)
+	elif isinstance(obj, int):
+		if 0 <= obj < 0x80:
+			data.append(obj)
+		elif 0x80 <= obj < 0x100:
+			data.append(0xcc)
+			data.append(obj)
+		elif -32 <= obj < 0:
+			data.append(obj & 0xff)
+		else:
+			data.append(0xd3)
+			data += _int64.pack(obj)
+	elif isinstance(obj, float):
+		data.append(0xcb)
+		data += _float64.pack(obj)
+	elif isinstance(obj, (list, tuple)):
+		_pack_length(len(obj), 0x90, 15, None, 0xdc, 0xdd, data)
+		for item in obj:
+			# Lists of small integers, such as braille cells, are common enough to be handled inline
+			if item.__class__ is int and 0 <= item < 0x100:
+				if item >= 0x80:
+					data.append(0xcc)
+				data.append(item)
+			else:
+				pack(item, data)
+	elif isinstance(obj, dict):
+		_pack_length(len(obj), 0x80, 15, None, 0xde, 0xdf, data)
+		for key, value in obj.items():
+			pack(key, data)
+			pack(value, data)
+	elif isinstance(obj, (bytes, bytearray)):
+		_pack_length(len(obj), 0, -1, 0xc4, 0xc5, 0xc6, data)
+		data += obj
+	else:
+		pack(speech_commands.encode(obj), data)
+
+
+def _unpack_items(data, offset, count):
+	items = []
+	for i in range(count):
+		tag = data[offset]
+		if tag < 0x80:
+			items.append(tag)
+			offset += 1
+		elif tag == 0xcc:
+			items.append(data[offset + 1])
+			offset += 2
+		else:
+			item, offset = unpack(data, offset)
+			items.append(item)
+	return items, offset
+
+
+def _unpack_map(data, offset, count):
+	obj = {}
+	for i in range(count):
+		key, offset = unpack(data, offset)
+		obj[key], offset = unpack(data, offset)
+	return obj, offset
+
+
+def _unpack_length(data, offset, size):
+	if size == 1:
+		return data[offset], offset + 1
+	elif size == 2:
+		return _uint16.unpack_from(data, offset)[0], offset + 2
+	return _uint32.unpack_from(data, offset)[0], offset + 4
+
+
+def unpack(data, offset):
+	"""Reads an object from data at offset. Returns the object and the offset after it."""
+	tag = data[offset]
+	offset += 1
+	if tag < 0x80:
+		return tag, offset
+	elif tag >= 0xe0:
+		return tag - 0x100, offset
+	elif 0xa0 <= tag <= 0xbf:
+		end = offset + (tag & 0x1f)
+		return data[offset:end].decode('utf-8', 'surrogatepass'), end
+	elif 0x90 <= tag <= 0x9f:
+		return _unpack_items(data, offset, tag & 0x0f)
+	elif 0x80 <= tag <= 0x8f:
+		return _unpack_map(data, offset, tag & 0x0f)
+	elif tag == 0xc0:
+		return None, offset
+	elif tag == 0xc2:
+		return False, offset
+	elif tag == 0xc3:
+		return True, offset
+	elif tag == 0xcc:
+		return data[offset], offset + 1
+	elif tag == 0xd3:
+		return _int64.unpack_from(data, offset)[0], offset + 8
+	elif tag == 0xcb:
+		return _float64.unpack_from(data, offset)[0], offset + 8
+	elif tag in (0xd9, 0xda, 0xdb):
+		length, offset = _unpack_length(data, offset, 1 << (tag - 0xd9))
+		end = offset + length
+		return data[offset:end].decode('utf-8', 'surrogatepass'), end
+	elif tag in (0xc4, 0xc5, 0xc6):
+		length, offset = _unpack_length(data, offset, 1 << (tag - 0xc4))
+		end = offset + length
+		return bytes(data[offset:end]), end
+	elif tag in (0xdc, 0xdd):
+		length, offset = _unpack_length(data, offset, 2 << (tag - 0xdc))
+		return _unpack_items(data, offset, length)
+	elif tag in (0xde, 0xdf):
+		length, offset = _unpack_length(data, offset, 2 << (tag - 0xde))
+		return _unpack_map(data, offset, length)
+	raise ValueError(f"Unsupported type 0x{tag:02x}")
+
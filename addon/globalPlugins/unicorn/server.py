@@ -1,5 +1,8 @@
+import asyncio
+import functools
 import os
-import select
+import random
+import selectors
 import socket
 import ssl
 import sys
@@ -10,70 +13,233 @@ except ImportError:
 	import json
 	sys.path.remove(sys.path[-1])
 import time
+from . import compression
+from . import framing
+from . import tracing
 
-class Server:
+CERT_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'server.pem')
+
+
+@functools.lru_cache(maxsize=None)
+def get_server_context():
+	"""Returns the TLS context of the relay servers, created when first needed and shared by all servers of the process.
+	The certificate is only loaded once, and session tickets issued by one server are valid for all of them."""
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+	context.load_cert_chain(CERT_FILE)
+	return context
+
+
+def create_server(*args, use_asyncio=False, **kwargs):
+	"""Creates a relay server using either the selector based or the asyncio event loop."""
+	if use_asyncio:
+		return AsyncServer(*args, **kwargs)
+	return Server(*args, **kwargs)
+
+
+class BaseServer:
+	"""Client bookkeeping shared by the relay servers, independent of their event loop.
+	When password is None, clients can create and join any channel, otherwise only the channel named password exists."""
 	PING_TIME = 300
+	KEY_LENGTH = 7
+	# Clients whose outbound buffer stays above the high-water mark for longer than the timeout are disconnected,
+	# as are clients exceeding the hard limit
+	OUTBOUND_HIGH_WATER = 256 * 1024
+	OUTBOUND_LIMIT = 4 * 1024 * 1024
+	SLOW_CONSUMER_TIMEOUT = 10
+	# Seconds a new connection has to complete the TLS handshake
+	HANDSHAKE_TIMEOUT = 10
 
-	def __init__(self, port, password, bind_host='', bind_host6='[::]'):
+	def __init__(self, port, password=None, max_message_size=framing.DEFAULT_MAX_MESSAGE_SIZE):
 		self.port = port
 		self.password = password
+		self.max_message_size = max_message_size
 		#Maps client sockets to clients
 		self.clients = {}
-		self.client_sockets = []
+		# Maps channels to the clients that joined them, keyed by client id
+		self.channels = {}
+		self.random = random.SystemRandom()
 		self.running = False
+		self.last_ping_time = time.time()
+
+	def add_client(self, client):
+		self.clients[client.socket] = client
+
+	def remove_client(self, client):
+		del self.clients[client.socket]
+		self.leave_channel(client)
+
+	def is_valid_channel(self, channel):
+		if not channel or not isinstance(channel, str):
+			return False
+		return self.password is None or channel == self.password
+
+	def join_channel(self, client, channel):
+		self.channels.setdefault(channel, {})[client.id] = client
+		client.channel = channel
+
+	def leave_channel(self, client):
+		members = self.channels.get(client.channel)
+		if members is None:
+			return
+		members.pop(client.id, None)
+		if not members:
+			del self.channels[client.channel]
+
+	def channel_members(self, channel):
+		return self.channels.get(channel, {}).values()
+
+	def generate_key(self):
+		"""Generates a channel key that is not in use."""
+		while True:
+			key = "".join(self.random.choice("0123456789") for i in range(self.KEY_LENGTH))
+			if key not in self.channels:
+				return key
+
+	def client_disconnected(self, client):
+		self.remove_client(client)
+		if client.authenticated:
+			client.send_to_others(type='client_left', user_id=client.id, client=client.as_dict())
+
+	def ping_clients(self):
+		for client in list(self.clients.values()):
+			if client.authenticated:
+				client.send(type='ping')
+		self.last_ping_time = time.time()
+
+
+class Server(BaseServer):
+
+	def __init__(self, port, password=None, bind_host='', bind_host6='[::]', **kwargs):
+		super().__init__(port, password, **kwargs)
+		# Sockets are registered once; the selector uses epoll/kqueue where available
+		self.selector = selectors.DefaultSelector()
 		self.server_socket = self.create_server_socket(socket.AF_INET, socket.SOCK_STREAM, bind_addr=(bind_host, self.port))
 		self.server_socket6 = self.create_server_socket(socket.AF_INET6, socket.SOCK_STREAM, bind_addr=(bind_host6, self.port))
+		self.selector.register(self.server_socket, selectors.EVENT_READ)
+		self.selector.register(self.server_socket6, selectors.EVENT_READ)
+		# Used by close to wake up the loop from another thread
+		self.wakeup_socket, self.wakeup_socket_writer = socket.socketpair()
+		self.selector.register(self.wakeup_socket, selectors.EVENT_READ)
+		# Clients with data written during the current loop pass
+		self.pending_writes = set()
+		# Clients whose TLS handshake is in progress
+		self.handshaking = set()
 
 	def create_server_socket(self, family, type, bind_addr):
 		server_socket = socket.socket(family, type)
-		certfile = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'server.pem')
-		server_socket = ssl.wrap_socket(server_socket, certfile=certfile)
 		server_socket.bind(bind_addr)
 		server_socket.listen(5)
+		# A connection reset before it is accepted mustn't block the loop
+		server_socket.setblocking(False)
 		return server_socket
 
 	def run(self):
 		self.running = True
 		self.last_ping_time = time.time()
 		while self.running:
-			r, w, e = select.select(self.client_sockets+[self.server_socket, self.server_socket6], [], self.client_sockets, 60)
+			self.poll(60)
+		self.selector.close()
+		self.wakeup_socket.close()
+		self.wakeup_socket_writer.close()
+
+	def poll(self, timeout):
+		"""Runs a single pass of the event loop, waiting at most timeout seconds for activity."""
+		if self.handshaking:
+			next_deadline = min(client.handshake_deadline for client in self.handshaking)
+			timeout = max(0, min(timeout, next_deadline - time.monotonic()))
+		for key, events in self.selector.select(timeout):
 			if not self.running:
-				break
-			for sock in r:
-				if sock is self.server_socket or sock is self.server_socket6:
-					self.accept_new_connection(sock)
+				return
+			client = key.data
+			if client is not None:
+				if client.handshake_deadline is not None:
+					if not client.closed:
+						self.continue_handshake(client)
 					continue
-				self.clients[sock].handle_data()
-			if time.time() - self.last_ping_time >= self.PING_TIME:
-				for client in self.clients.values():
-					if client.authenticated:
-						client.send(type='ping')
-				self.last_ping_time = time.time()
+				# Skip clients closed earlier during this pass
+				if not client.closed and events & selectors.EVENT_WRITE:
+					self.flush_client(client)
+				if not client.closed and events & selectors.EVENT_READ:
+					client.handle_data()
+			elif key.fileobj is self.wakeup_socket:
+				self.wakeup_socket.recv(512)
+			else:
+				self.accept_new_connection(key.fileobj)
+		if self.handshaking:
+			self.expire_handshakes()
+		if time.time() - self.last_ping_time >= self.PING_TIME:
+			self.ping_clients()
+		# All messages queued for a client during this pass go out in one write
+		while self.pending_writes:
+			self.flush_client(self.pending_writes.pop())
+
+	def flush_client(self, client):
+		if client.closed:
+			return
+		client.flush()
+		if client.closed:
+			return
+		waiting = bool(client.outbuf)
+		if waiting != client.want_write:
+			client.want_write = waiting
+			events = selectors.EVENT_READ | selectors.EVENT_WRITE if waiting else selectors.EVENT_READ
+			self.selector.modify(client.socket, events, client)
 
 	def accept_new_connection(self, sock):
 		try:
 			client_sock, addr = sock.accept()
-		except (ssl.SSLError, OSError):
+		except OSError:
+			return
+		try:
+			client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			client_sock.setblocking(False)
+			# The handshake is driven by the loop like any other I/O, so a peer that stalls it only delays itself
+			client_sock = get_server_context().wrap_socket(client_sock, server_side=True, do_handshake_on_connect=False)
+		except OSError:
+			client_sock.close()
 			return
-		client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 		client = Client(server=self, socket=client_sock)
+		client.handshake_deadline = time.monotonic() + self.HANDSHAKE_TIMEOUT
+		self.handshaking.add(client)
 		self.add_client(client)
 
+	def continue_handshake(self, client):
+		try:
+			client.socket.do_handshake()
+		except ssl.SSLWantReadError:
+			self.selector.modify(client.socket, selectors.EVENT_READ, client)
+			return
+		except ssl.SSLWantWriteError:
+			self.selector.modify(client.socket, selectors.EVENT_WRITE, client)
+			return
+		except OSError:
+			client.close()
+			return
+		client.handshake_deadline = None
+		self.handshaking.discard(client)
+		self.selector.modify(client.socket, selectors.EVENT_READ, client)
+
+	def expire_handshakes(self):
+		now = time.monotonic()
+		for client in [client for client in self.handshaking if client.handshake_deadline <= now]:
+			client.close()
+
 	def add_client(self, client):
-		self.clients[client.socket] = client
-		self.client_sockets.append(client.socket)
+		super().add_client(client)
+		self.selector.register(client.socket, selectors.EVENT_READ, client)
 
 	def remove_client(self, client):
-		del self.clients[client.socket]
-		self.client_sockets.remove(client.socket)
-
-	def client_disconnected(self, client):
-		self.remove_client(client)
-		if client.authenticated:
-			client.send_to_others(type='client_left', user_id=client.id, client=client.as_dict())
+		super().remove_client(client)
+		self.selector.unregister(client.socket)
+		self.pending_writes.discard(client)
+		self.handshaking.discard(client)
 
 	def close(self):
 		self.running = False
+		try:
+			self.wakeup_socket_writer.send(b'\0')
+		except OSError:
+			pass
 		self.server_socket.close()
 		self.server_socket6.close()
 
@@ -83,42 +249,66 @@ class Client:
 	def __init__(self, server, socket):
 		self.server = server
 		self.socket = socket
-		self.buffer = ""
+		self.stream = compression.ReceiveStream(framing.LineFramer(server.max_message_size))
 		self.authenticated = False
+		self.closed = False
+		self.channel = None
 		self.id = Client.id + 1
 		self.connection_type = None
 		self.protocol_version = 1
 		Client.id += 1
+		# Data waiting to be written to the socket
+		self.outbuf = bytearray()
+		self.want_write = False
+		self.backlogged_since = None
+		# Time by which the TLS handshake must be complete, None once it is or when the server does the handshake itself
+		self.handshake_deadline = None
+		# Set once both ends agreed on compression
+		self.compressor = None
+		# Whether the compressor holds data that has not been flushed to outbuf
+		self.compressor_pending = False
 
 	def handle_data(self):
-		sock_data = ''
 		try:
-			sock_data = self.socket.recv(16384).decode(errors="surrogatepass")
+			sock_data = self.socket.recv(16384)
+		except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+			return
 		except:
 			self.close()
 			return
-		if sock_data == '': #Disconnect
+		if not sock_data: #Disconnect
 			self.close()
 			return
-		data = self.buffer + sock_data
-		if '\n' not in data:
-			self.buffer = data
-			return
-		self.buffer = ""
-		while '\n' in data:
-			line, sep, data = data.partition('\n')
-			try:
-				self.parse(line)
-			except ValueError:
-				self.close()
-				return
-		self.buffer += data
+		self.receive(sock_data)
+
+	def receive(self, data):
+		try:
+			self.stream.feed(data)
+			for line in self.stream:
+				self.parse(line.decode(errors="surrogatepass"))
+				if self.closed:
+					return
+		except ValueError:
+			# Invalid, corrupt or too large message
+			self.close()
 
 	def parse(self, line):
 		parsed = json.loads(line)
 		if 'type' not in parsed:
 			return
+		if parsed['type'] == 'compression':
+			# Applies to this connection only, so it is never relayed
+			self.stream.start_decompression(parsed.get('name'), compression.METHODS)
+			return
+		if parsed['type'] == 'ping' and 'time' in parsed:
+			# Answered by the server rather than relayed, clients check their connection to the server with it
+			# Marked, so clients tell it from pongs of other clients passed on by older relays
+			self.send(type='pong', time=parsed['time'], clock=time.time(), relay=True)
+			return
 		if self.authenticated:
+			if isinstance(parsed.get('trace'), dict):
+				# Stamped for clients measuring the latency of speech and braille
+				parsed['trace'][tracing.RELAYED] = time.time()
 			self.send_to_others(**parsed)
 			return
 		fn = 'do_'+parsed['type']
@@ -129,8 +319,8 @@ class Client:
 		return dict(id=self.id, connection_type=self.connection_type)
 
 	def do_join(self, obj):
-		password = obj.get('channel', None)
-		if password != self.server.password:
+		channel = obj.get('channel', None)
+		if not self.server.is_valid_channel(channel):
 			self.send(type='error', message='incorrect_password')
 			self.close()
 			return
@@ -138,23 +328,40 @@ class Client:
 		self.authenticated = True
 		clients = []
 		client_ids = []
-		for c in list(self.server.clients.values()):
-			if c is self or not c.authenticated:
-				continue
+		for c in self.server.channel_members(channel):
 			clients.append(c.as_dict())
 			client_ids.append(c.id)
-		self.send(type='channel_joined', channel=self.server.password, user_ids=client_ids, clients=clients)
+		self.server.join_channel(self, channel)
+		self.send(type='channel_joined', channel=channel, user_ids=client_ids, clients=clients)
 		self.send_to_others(type='client_joined', user_id=self.id, client=self.as_dict())
 
+	def do_generate_key(self, obj):
+		self.send(type='generate_key', key=self.server.generate_key())
+
 	def do_protocol_version(self, obj):
 		version = obj.get('version')
 		if not version:
 			return
 		self.protocol_version = version
+		method = compression.negotiate(compression.METHODS, obj.get('compression') or ())
+		if method is not None and self.compressor is None:
+			# Everything written after this message is compressed
+			self.send(type='compression', name=method)
+			self.compressor = compression.Compressor()
 
 	def close(self):
-		self.socket.close()
+		if self.closed:
+			return
+		self.closed = True
 		self.server.client_disconnected(self)
+		self.flush_compressor()
+		if self.outbuf:
+			# Best effort delivery of the last messages, such as an error
+			try:
+				self.socket.send(self.outbuf)
+			except OSError:
+				pass
+		self.socket.close()
 
 	def send(self, type, origin=None, clients=None, client=None, **kwargs):
 		msg = dict(type=type, **kwargs)
@@ -166,14 +373,178 @@ class Client:
 			if client:
 				msg['client'] = client
 		msgstr = json.dumps(msg)+"\n"
+		self.write(msgstr.encode(errors="surrogatepass"))
+
+	def write(self, data):
+		"""Queues data to be written when the socket is writable."""
+		if self.closed:
+			return
+		if self.compressor is not None:
+			data = self.compressor.compress(data)
+			self.compressor_pending = True
+		self.outbuf += data
+		if self.check_backlog(len(self.outbuf)):
+			self.server.pending_writes.add(self)
+
+	def flush_compressor(self):
+		"""Completes the compressed data of everything written so far."""
+		if self.compressor_pending:
+			self.compressor_pending = False
+			self.outbuf += self.compressor.flush()
+
+	def flush(self):
+		self.flush_compressor()
 		try:
-			self.socket.sendall(msgstr.encode(errors="surrogatepass"))
-		except:
+			sent = self.socket.send(self.outbuf)
+		except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+			return
+		except OSError:
 			self.close()
+			return
+		del self.outbuf[:sent]
+		self.check_backlog(len(self.outbuf))
+
+	def check_backlog(self, size):
+		"""Disconnects the client when it does not keep up with the data sent to it.
+		Returns whether the client is still connected."""
+		if size <= self.server.OUTBOUND_HIGH_WATER:
+			self.backlogged_since = None
+			return True
+		now = time.time()
+		if self.backlogged_since is None:
+			self.backlogged_since = now
+		if size > self.server.OUTBOUND_LIMIT or now - self.backlogged_since > self.server.SLOW_CONSUMER_TIMEOUT:
+			self.close()
+			return False
+		return True
 
 	def send_to_others(self, origin=None, **obj):
 		if origin is None:
 			origin = self.id
-		for c in self.server.clients.values():
-			if c is not self and c.authenticated:
+		# Sending can disconnect a member, which changes the channel
+		for c in tuple(self.server.channel_members(self.channel)):
+			if c is not self:
 				c.send(origin=origin, **obj)
+
+
+class AsyncServer(BaseServer):
+	"""Relay server speaking the same protocol as Server, running one coroutine per connection on an asyncio event loop.
+	A slow peer only delays its own coroutine instead of the whole relay."""
+
+	def __init__(self, port, password=None, bind_host='', bind_host6='[::]', **kwargs):
+		super().__init__(port, password, **kwargs)
+		self.loop = None
+		self.stop_event = None
+		self.connection_tasks = set()
+		self.ssl_context = get_server_context()
+		self.server_socket = self.create_server_socket(socket.AF_INET, socket.SOCK_STREAM, bind_addr=(bind_host, self.port))
+		self.server_socket6 = self.create_server_socket(socket.AF_INET6, socket.SOCK_STREAM, bind_addr=(bind_host6, self.port))
+
+	def create_server_socket(self, family, type, bind_addr):
+		server_socket = socket.socket(family, type)
+		server_socket.bind(bind_addr)
+		server_socket.listen(100)
+		return server_socket
+
+	def run(self):
+		self.running = True
+		self.loop = asyncio.new_event_loop()
+		try:
+			self.loop.run_until_complete(self.serve())
+		finally:
+			self.loop.close()
+
+	async def serve(self):
+		self.stop_event = asyncio.Event()
+		servers = []
+		for sock in (self.server_socket, self.server_socket6):
+			servers.append(await asyncio.start_server(
+				self.handle_connection,
+				sock=sock,
+				ssl=self.ssl_context,
+				ssl_handshake_timeout=self.HANDSHAKE_TIMEOUT,
+			))
+		self.last_ping_time = time.time()
+		while self.running:
+			try:
+				await asyncio.wait_for(self.stop_event.wait(), self.PING_TIME)
+			except asyncio.TimeoutError:
+				self.ping_clients()
+		for server in servers:
+			server.close()
+			await server.wait_closed()
+		for client in list(self.clients.values()):
+			client.close()
+		await asyncio.gather(*self.connection_tasks, return_exceptions=True)
+
+	async def handle_connection(self, reader, writer):
+		sock = writer.get_extra_info('socket')
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		client = AsyncClient(server=self, reader=reader, writer=writer)
+		self.add_client(client)
+		task = asyncio.current_task()
+		self.connection_tasks.add(task)
+		try:
+			await client.serve()
+		finally:
+			self.connection_tasks.discard(task)
+
+	def close(self):
+		self.running = False
+		if self.loop is not None and self.stop_event is not None:
+			try:
+				self.loop.call_soon_threadsafe(self.stop_event.set)
+			except RuntimeError:
+				# The loop has already been closed
+				pass
+		else:
+			self.server_socket.close()
+			self.server_socket6.close()
+
+
+class AsyncClient(Client):
+
+	def __init__(self, server, reader, writer):
+		super().__init__(server=server, socket=writer.get_extra_info('socket'))
+		self.reader = reader
+		self.writer = writer
+
+	async def serve(self):
+		try:
+			while not self.closed:
+				data = await self.reader.read(16384)
+				if not data:
+					break
+				self.receive(data)
+		except OSError:
+			pass
+		finally:
+			self.close()
+
+	def close(self):
+		if self.closed:
+			return
+		# The transport still sends buffered data after being closed
+		self.flush_compressor()
+		self.closed = True
+		self.server.client_disconnected(self)
+		self.writer.close()
+		# Wakes up serve if the connection is closed from elsewhere
+		self.reader.feed_eof()
+
+	def write(self, data):
+		if self.closed:
+			return
+		if self.compressor is not None:
+			data = self.compressor.compress(data)
+			if not self.compressor_pending:
+				# Everything written during this pass of the event loop is flushed at once
+				self.compressor_pending = True
+				self.server.loop.call_soon(self.flush_compressor)
+		self.writer.write(data)
+		self.check_backlog(self.writer.transport.get_write_buffer_size())
+
+	def flush_compressor(self):
+		if self.compressor_pending and not self.closed:
+			self.compressor_pending = False
+			self.writer.write(self.compressor.flush())
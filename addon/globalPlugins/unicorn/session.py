@@ -3,9 +3,14 @@ import time
 import speech
 import braille
 from . import nvda_patcher
+from . import display_delta
 from collections import defaultdict
 import tones
 import synthDriverHandler
+import core
+
+# Default maximum number of braille frames sent per second
+DISPLAY_FRAME_RATE = 20
 
 
 class RemoteSession(object):
@@ -13,26 +18,36 @@ class RemoteSession(object):
 	def __init__(self, local_machine, transport):
 		self.local_machine = local_machine
 		self.patcher = None
+		# Callbacks are registered weakly, so the transport and patcher don't keep a session alive once it is dropped
 		self.transport = transport
 
 
 class SlaveSession(RemoteSession):
 	"""Session that runs on the slave and manages state."""
 
-	def __init__(self, *args, is_secondary=False, **kwargs):
+	def __init__(self, *args, is_secondary=False, display_frame_rate=DISPLAY_FRAME_RATE, **kwargs):
 		super(SlaveSession, self).__init__(*args, **kwargs)
-		self.transport.callback_manager.register_callback('msg_client_joined', self.handle_client_connected)
-		self.transport.callback_manager.register_callback('msg_client_left', self.handle_client_disconnected)
+		self.transport.callback_manager.register_callback('msg_client_joined', self.handle_client_connected, weak=True)
+		self.transport.callback_manager.register_callback('msg_client_left', self.handle_client_disconnected, weak=True)
 		self.masters = defaultdict(dict)
 		self.master_display_sizes = []
-		self.transport.callback_manager.register_callback('transport_disconnected', self.handle_disconnected)
-		self.transport.callback_manager.register_callback('transport_closing', self.handle_transport_closing)
+		self.transport.callback_manager.register_callback('transport_disconnected', self.handle_disconnected, weak=True)
+		self.transport.callback_manager.register_callback('transport_closing', self.handle_transport_closing, weak=True)
 		self.patcher = nvda_patcher.NVDASlavePatcher(is_secondary=is_secondary)
 		self.patch_callbacks_added = False
-		self.transport.callback_manager.register_callback('msg_channel_joined', self.handle_channel_joined)
-		self.transport.callback_manager.register_callback('msg_set_braille_info', self.handle_braille_info)
-		self.transport.callback_manager.register_callback('msg_set_display_size', self.set_display_size)
-		self.transport.callback_manager.register_callback('msg_braille_input', self.local_machine.braille_input)
+		self.transport.callback_manager.register_callback('msg_channel_joined', self.handle_channel_joined, weak=True)
+		self.transport.callback_manager.register_callback('msg_set_braille_info', self.handle_braille_info, weak=True)
+		self.transport.callback_manager.register_callback('msg_set_display_size', self.set_display_size, weak=True)
+		self.transport.callback_manager.register_callback('msg_braille_input', self.local_machine.braille_input, weak=True)
+		self.transport.callback_manager.register_callback('msg_display_keyframe_request', self.handle_display_keyframe_request, weak=True)
+		# The last frame sent to masters that support display deltas, None when the next frame should be a keyframe
+		self.display_frame = None
+		self.display_frame_id = 0
+		# Frames are conflated: while the rate limit holds a frame back, a newer frame replaces it
+		self.display_interval = 1.0 / display_frame_rate
+		self.last_display_time = 0
+		self.pending_display = None
+		self.display_timer = None
 
 	def handle_client_connected(self, client=None, **kwargs):
 		self.patcher.patch()
@@ -42,6 +57,8 @@ class SlaveSession(RemoteSession):
 		self.patcher.orig_beep(1000, 300)
 		if client['connection_type'] == 'master':
 			self.masters[client['id']]['active'] = True
+			# The new master doesn't know the previous frame
+			self.display_frame = None
 
 	def handle_channel_joined(self, channel=None, clients=None, origin=None, **kwargs):
 		if clients is None:
@@ -51,8 +68,11 @@ class SlaveSession(RemoteSession):
 
 	def handle_disconnected(self):
 		self.masters.clear()
+		self.display_frame = None
+		self.cancel_pending_display()
 
 	def handle_transport_closing(self):
+		self.cancel_pending_display()
 		self.patcher.unpatch()
 		if self.patch_callbacks_added:
 			self.remove_patch_callbacks()
@@ -74,6 +94,7 @@ class SlaveSession(RemoteSession):
 			return
 		self.masters[origin]['braille_name'] = name
 		self.masters[origin]['braille_numCells'] = numCells
+		self.masters[origin]['display_delta'] = kwargs.get('display_delta', False)
 		self.set_display_size()
 
 	def add_patch_callbacks(self):
@@ -86,7 +107,7 @@ class SlaveSession(RemoteSession):
 			('set_display', self.set_display_size)
 		)
 		for event, callback in patcher_callbacks:
-			self.patcher.register_callback(event, callback)
+			self.patcher.register_callback(event, callback, weak=True)
 
 	def remove_patch_callbacks(self):
 		patcher_callbacks = (
@@ -100,8 +121,8 @@ class SlaveSession(RemoteSession):
 		for event, callback in patcher_callbacks:
 			self.patcher.unregister_callback(event, callback)
 
-	def speak(self, speechSequence, priority):
-		self.transport.send(type="speak", sequence=speechSequence, priority=priority)
+	def speak(self, speechSequence, priority, trace=None):
+		self.transport.send(type="speak", sequence=speechSequence, priority=priority, trace=trace)
 
 	def cancel_speech(self):
 		self.transport.send(type="cancel")
@@ -112,14 +133,68 @@ class SlaveSession(RemoteSession):
 	def playWaveFile(self, fileName, asynchronous=True):
 		self.transport.send(type='wave', fileName=fileName, asynchronous=asynchronous)
 
-	def display(self, cells):
+	def display(self, cells, trace=None):
 		# Only send braille data when there are controlling machines with a braille display
-		if self.has_braille_masters():
-			self.transport.send(type="display", cells=cells)
+		if not self.has_braille_masters():
+			return
+		if self.display_timer is not None:
+			self.pending_display = (cells, trace)
+			return
+		delay = self.last_display_time + self.display_interval - time.monotonic()
+		if delay > 0:
+			self.pending_display = (cells, trace)
+			self.display_timer = core.callLater(int(delay * 1000) + 1, self.send_pending_display)
+			return
+		self.send_display(cells, trace=trace)
+
+	def send_pending_display(self):
+		"""Sends the newest frame that was held back by the rate limit."""
+		self.display_timer = None
+		pending = self.pending_display
+		self.pending_display = None
+		if pending is not None and self.has_braille_masters():
+			cells, trace = pending
+			self.send_display(cells, trace=trace)
+
+	def cancel_pending_display(self):
+		if self.display_timer is not None:
+			self.display_timer.Stop()
+			self.display_timer = None
+		self.pending_display = None
+
+	def send_display(self, cells, trace=None):
+		self.last_display_time = time.monotonic()
+		if self.masters_support_display_delta():
+			self.send_display_delta(cells, trace=trace)
+		else:
+			self.transport.send(type="display", cells=cells, trace=trace)
+
+	def send_display_delta(self, cells, trace=None):
+		"""Sends the cells that changed since the previous frame, or a keyframe containing all cells."""
+		previous = self.display_frame
+		self.display_frame_id += 1
+		if previous is None or len(previous) != len(cells):
+			base = None
+			runs = display_delta.keyframe(cells)
+		else:
+			base = self.display_frame_id - 1
+			runs = display_delta.diff(previous, cells)
+		self.display_frame = list(cells)
+		self.transport.send(type="display_delta", frame=self.display_frame_id, base=base, size=len(cells), runs=runs, trace=trace)
+
+	def handle_display_keyframe_request(self, **kwargs):
+		frame = self.display_frame
+		self.display_frame = None
+		if frame is not None and self.masters_support_display_delta():
+			self.send_display_delta(frame)
 
 	def has_braille_masters(self):
 		return bool([i for i in self.master_display_sizes if i > 0])
 
+	def masters_support_display_delta(self):
+		braille_masters = [info for info in self.masters.values() if info.get('braille_numCells')]
+		return bool(braille_masters) and all(info.get('display_delta') for info in braille_masters)
+
 class MasterSession(RemoteSession):
 
 	def __init__(self, *args, **kwargs):
@@ -127,15 +202,16 @@ class MasterSession(RemoteSession):
 		self.slaves = defaultdict(dict)
 		self.patcher = nvda_patcher.NVDAMasterPatcher()
 		self.patch_callbacks_added = False
-		self.transport.callback_manager.register_callback('msg_speak', self.local_machine.speak)
-		self.transport.callback_manager.register_callback('msg_cancel', self.local_machine.cancel_speech)
-		self.transport.callback_manager.register_callback('msg_tone', self.local_machine.beep)
-		self.transport.callback_manager.register_callback('msg_wave', self.local_machine.play_wave)
-		self.transport.callback_manager.register_callback('msg_display', self.local_machine.display)
-		self.transport.callback_manager.register_callback('msg_client_joined', self.handle_client_connected)
-		self.transport.callback_manager.register_callback('msg_client_left', self.handle_client_disconnected)
-		self.transport.callback_manager.register_callback('msg_channel_joined', self.handle_channel_joined)
-		self.transport.callback_manager.register_callback('msg_send_braille_info', self.send_braille_info)
+		self.transport.callback_manager.register_callback('msg_speak', self.local_machine.speak, weak=True)
+		self.transport.callback_manager.register_callback('msg_cancel', self.local_machine.cancel_speech, weak=True)
+		self.transport.callback_manager.register_callback('msg_tone', self.local_machine.beep, weak=True)
+		self.transport.callback_manager.register_callback('msg_wave', self.local_machine.play_wave, weak=True)
+		self.transport.callback_manager.register_callback('msg_display', self.local_machine.display, weak=True)
+		self.transport.callback_manager.register_callback('msg_display_delta', self.handle_display_delta, weak=True)
+		self.transport.callback_manager.register_callback('msg_client_joined', self.handle_client_connected, weak=True)
+		self.transport.callback_manager.register_callback('msg_client_left', self.handle_client_disconnected, weak=True)
+		self.transport.callback_manager.register_callback('msg_channel_joined', self.handle_channel_joined, weak=True)
+		self.transport.callback_manager.register_callback('msg_send_braille_info', self.send_braille_info, weak=True)
 
 	def handle_channel_joined(self, channel=None, clients=None, origin=None, **kwargs):
 		if clients is None:
@@ -160,7 +236,12 @@ class MasterSession(RemoteSession):
 
 	def send_braille_info(self, **kwargs):
 		display = braille.handler.display
-		self.transport.send(type="set_braille_info", name=display.name, numCells=display.numCells or braille.handler.displaySize)
+		self.transport.send(type="set_braille_info", name=display.name, numCells=display.numCells or braille.handler.displaySize, display_delta=True)
+
+	def handle_display_delta(self, origin=None, **kwargs):
+		if not self.local_machine.display_delta(origin=origin, **kwargs):
+			# We missed the frame the delta is based on
+			self.transport.send(type="display_keyframe_request")
 
 	def braille_input(self, **kwargs):
 		self.transport.send(type="braille_input", **kwargs)
@@ -168,7 +249,7 @@ class MasterSession(RemoteSession):
 	def add_patch_callbacks(self):
 		patcher_callbacks = (('braille_input', self.braille_input), ('set_display', self.send_braille_info))
 		for event, callback in patcher_callbacks:
-			self.patcher.register_callback(event, callback)
+			self.patcher.register_callback(event, callback, weak=True)
 
 	def remove_patch_callbacks(self):
 		patcher_callbacks = (('braille_input', self.braille_input), ('set_display', self.send_braille_info))
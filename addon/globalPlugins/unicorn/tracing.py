@@ -0,0 +1,134 @@
+"""Optional tracing of the latency of speech and braille from the slave to the master.
+A traced message carries a trace, a dictionary of the times at which it passed each stage.
+Times are recorded by the clock of the machine passing the stage,
+and converted to the clock of the master when received, using the clock offsets estimated by the heartbeats."""
+
+import threading
+import time
+
+# Stages of a traced message, in the order they are passed
+HOOK = 'hook'  # NVDA spoke or displayed on the slave
+SENT = 'sent'  # The send queue of the slave wrote the message
+RELAYED = 'relayed'  # The relay server passed the message on
+RECEIVED = 'received'  # The transport of the master parsed the message
+OUTPUT = 'output'  # The master spoke or displayed the message
+STAGES = (HOOK, SENT, RELAYED, RECEIVED, OUTPUT)
+# Key of the estimated offset of the clock of the sender's peer to the clock of the sender
+OFFSET = 'offset'
+# Upper bounds of the histogram buckets in milliseconds, the last bucket holds everything above
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+class TracedMessage:
+	"""A queued message whose trace is stamped with the time it is sent.
+	It is serialized when the send queue takes it, rather than when it is queued."""
+	__slots__ = ('serializer', 'type', 'kwargs')
+
+	def __init__(self, serializer, type, kwargs):
+		self.serializer = serializer
+		self.type = type
+		self.kwargs = kwargs
+
+	def serialize(self):
+		self.kwargs['trace'][SENT] = time.time()
+		return self.serializer.serialize(type=self.type, **self.kwargs)
+
+
+def to_local_clock(trace, offset):
+	"""Converts the times of a received trace to the local clock, given the offset of the clock of the peer to the local clock.
+	When the message passed a relay, the peer is the relay, and the trace holds the offset of the relay to the sender."""
+	offset = offset or 0
+	sender_offset = trace.pop(OFFSET, None) or 0
+	relayed = RELAYED in trace
+	for stage, stamp in trace.items():
+		if not isinstance(stamp, (int, float)):
+			continue
+		if relayed and stage != RELAYED:
+			stamp += sender_offset
+		trace[stage] = stamp - offset
+
+
+class Histogram:
+	"""Counts of latencies by bucket."""
+
+	def __init__(self):
+		self.counts = [0] * (len(BUCKETS) + 1)
+		self.count = 0
+		self.total = 0
+		self.maximum = 0
+
+	def add(self, latency):
+		# Latencies below zero are errors of the clock offset estimate
+		ms = max(latency * 1000, 0)
+		index = 0
+		while index < len(BUCKETS) and ms > BUCKETS[index]:
+			index += 1
+		self.counts[index] += 1
+		self.count += 1
+		self.total += ms
+		self.maximum = max(self.maximum, ms)
+
+	def percentile(self, fraction):
+		"""Returns the upper bound of the bucket holding the given fraction of the latencies, in milliseconds."""
+		target = fraction * self.count
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if seen >= target and count:
+				return BUCKETS[index] if index < len(BUCKETS) else self.maximum
+		return 0
+
+	def __str__(self):
+		if not self.count:
+			return "no samples"
+		buckets = ", ".join(
+			f"<={BUCKETS[index] if index < len(BUCKETS) else 'inf'}: {count}"
+			for index, count in enumerate(self.counts) if count
+		)
+		return f"{self.count} samples, mean {self.total / self.count:.1f} ms, p50 <={self.percentile(0.5)} ms, p95 <={self.percentile(0.95)} ms, max {self.maximum:.1f} ms ({buckets})"
+
+
+class Tracer:
+	"""Starts traces on the slave and collects the latencies of the traces that completed on the master, by kind and stage."""
+
+	def __init__(self):
+		self.enabled = False
+		self.lock = threading.Lock()
+		self.histograms = {}
+
+	def start(self):
+		"""Returns a new trace stamped with the hook stage, or None when tracing is disabled."""
+		if not self.enabled:
+			return None
+		return {HOOK: time.time()}
+
+	def finish(self, kind, trace):
+		"""Stamps trace with the output stage and adds the latency of each stage to the histograms of kind."""
+		if trace is None or not self.enabled:
+			return
+		trace[OUTPUT] = time.time()
+		stamps = [(stage, trace[stage]) for stage in STAGES if isinstance(trace.get(stage), (int, float))]
+		with self.lock:
+			for (start_stage, start), (end_stage, end) in zip(stamps, stamps[1:]):
+				self.add(kind, f"{start_stage} to {end_stage}", end - start)
+			if len(stamps) > 1:
+				self.add(kind, "total", stamps[-1][1] - stamps[0][1])
+
+	def add(self, kind, stage, latency):
+		histogram = self.histograms.get((kind, stage))
+		if histogram is None:
+			histogram = self.histograms[(kind, stage)] = Histogram()
+		histogram.add(latency)
+
+	def reset(self):
+		with self.lock:
+			self.histograms.clear()
+
+	def report(self):
+		with self.lock:
+			# Stages of a kind stay in the order they were first recorded, which is the order they are passed
+			histograms = sorted(self.histograms.items(), key=lambda item: item[0][0])
+			return "\n".join(f"{kind} {stage}: {histogram}" for (kind, stage), histogram in histograms)
+
+
+tracer = Tracer()
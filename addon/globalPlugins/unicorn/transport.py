@@ -1,77 +1,319 @@
+import codecs
+import hmac
+import random
 import threading
 import time
 import queue
+from collections import deque
 import ssl
 import socket
 import select
 from logHandler import log
 from . import callback_manager
+from . import compression
+from . import framing
+from . import metrics
+from .heartbeat import Heartbeat, MESSAGES as HEARTBEAT_MESSAGES
+from .serializer import SERIALIZERS
+from . import tracing
 import ctypes.wintypes
 from . import unicorn
 import core
 
 PROTOCOL_VERSION = 2
 DVCTYPES = ('slave', 'master')
+# Maximum number of characters written at once by the send queue
+MAX_BATCH_SIZE = 64 * 1024
+# Number of batches after which the average batch size is logged
+BATCH_LOG_INTERVAL = 1000
+# Messages that change how the remote end decodes the data after them,
+# they are handled as soon as they are received and always end their batch
+SWITCH_MESSAGES = ('serializer', 'compression')
+
+
+def create_client_context():
+	"""Returns the TLS context for connections to relay servers.
+	Relay servers use self signed certificates, so they are not verified."""
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
+	return context
+
+
+# Shared by all outbound connections, sessions can only be resumed with the context that created them
+client_context = create_client_context()
 
 
 class Transport:
+	# Whether only pongs sent by a relay server count, see handle_heartbeat
+	RELAY_PONGS_ONLY = False
 
-	def __init__(self, serializer):
+	def __init__(self, serializer, max_batch_size=MAX_BATCH_SIZE, heartbeat=None):
 		self.serializer = serializer
+		# Serializer of received messages, which differs from the one of sent messages while switching serializers
+		self.inbound_serializer = serializer
 		self.callback_manager = callback_manager.CallbackManager()
 		self.connected = False
 		self.successful_connects = 0
+		self.max_batch_size = max_batch_size
+		self.batch_count = 0
+		self.batched_messages = 0
+		# Message taken from the queue that belongs in the next batch
+		self.held_item = None
+		# Handlers of the received SWITCH_MESSAGES this transport supports, by message type
+		self.switch_handlers = {}
+		# Set once both ends agreed on compression, each direction is switched by a compression message
+		self.compressor = None
+		self.decompressor = None
+		# Serializing and queuing a message is atomic, so no message is serialized by the wrong serializer
+		# when switching serializers while messages are sent from other threads
+		self.send_lock = threading.RLock()
+		self.heartbeat = heartbeat if heartbeat is not None else Heartbeat()
+		self.metrics = metrics.TransportMetrics()
 
 	def transport_connected(self):
 		self.successful_connects += 1
 		self.connected = True
+		self.heartbeat.start(self.send, self.on_heartbeat_timeout)
 		self.callback_manager.call_callbacks('transport_connected')
 
+	def on_heartbeat_timeout(self):
+		"""Disconnects from an end that stopped answering, so the connector thread connects again."""
+		self._disconnect()
+
+	def parse(self, data):
+		if self.callback_manager.has_callbacks('transport_raw_message', include_all=False):
+			type = self.inbound_serializer.peek_type(data)
+			if type is not None and type not in self.switch_handlers and type not in HEARTBEAT_MESSAGES:
+				self.callback_manager.call_callbacks('transport_raw_message', type, data, self.inbound_serializer)
+				if not self.callback_manager.has_callbacks('msg_' + type):
+					# Nothing else handles the message, so it needn't be decoded
+					self.metrics.received.add(type, len(data))
+					return
+		start = time.perf_counter()
+		obj = self.inbound_serializer.deserialize(data)
+		self.metrics.deserialize_time += time.perf_counter() - start
+		self.metrics.received.add(obj.get('type'), len(data))
+		handler = self.switch_handlers.get(obj.get('type'))
+		if handler is not None:
+			# Handled right away rather than through the callback manager,
+			# since the data received next depends on it
+			handler(obj.get('name'))
+			return
+		if obj.get('type') in HEARTBEAT_MESSAGES:
+			self.handle_heartbeat(obj)
+			return
+		trace = obj.get('trace')
+		if isinstance(trace, dict):
+			tracing.to_local_clock(trace, self.heartbeat.clock_offset)
+			trace[tracing.RECEIVED] = time.time()
+		self.dispatch(obj)
+
+	def handle_heartbeat(self, obj):
+		# Answered on the receiving thread, so the round trip time doesn't depend on how busy the main thread is
+		if obj['type'] == 'pong':
+			if self.RELAY_PONGS_ONLY and not obj.get('relay'):
+				# Relays that predate the heartbeat pass pings on, so this is the answer of another client.
+				# It says nothing about the connection to the relay, and stops coming when that client leaves
+				return
+			self.heartbeat.pong_received(obj.get('time'), clock=obj.get('clock'))
+		elif 'time' in obj:
+			# Pings without time, as sent by older relay servers, need no answer
+			self.send('pong', time=obj['time'], clock=time.time())
+
+	def dispatch(self, obj):
+		if 'type' not in obj:
+			return
+		callback = "msg_" + obj['type']
+		del obj['type']
+		self.callback_manager.call_callbacks(callback, **obj)
+
+	def serialize(self, type, kwargs):
+		"""Returns the queued form of a message: serialized, or a tracing.TracedMessage when it carries a trace."""
+		trace = kwargs.get('trace', False)
+		if trace is None:
+			del kwargs['trace']
+		elif trace is not False:
+			trace[tracing.OFFSET] = self.heartbeat.clock_offset
+			return tracing.TracedMessage(self.serializer, type, kwargs)
+		start = time.perf_counter()
+		data = self.serializer.serialize(type=type, **kwargs)
+		self.metrics.serialize_time += time.perf_counter() - start
+		return data
+
+	def send_raw(self, type, data, serializer):
+		"""Queues a message received by another transport as it was received, without separator.
+		It is only decoded and serialized again when serializer differs from the serializer of this transport."""
+		with self.send_lock:
+			if serializer.name != self.serializer.name:
+				obj = serializer.deserialize(data)
+				del obj['type']
+				self.send(type, **obj)
+			elif self.connected:
+				self.queue.put((type, self.serializer.frame(data)))
+
+	def get_batch(self):
+		"""Waits for a queued message and takes all messages queued after it, up to max_batch_size characters.
+		Text and binary messages are never mixed in one batch.
+		Returns the (type, serialized message) pairs. The last item is None when the send queue should stop after the batch."""
+		if self.held_item is not None:
+			item, self.held_item = self.held_item, None
+		else:
+			item = self.queue.get()
+		batch = []
+		size = 0
+		# Set by the first message, which always starts the batch, so a batch is never empty
+		binary = None
+		while item is not None:
+			data = item[1]
+			if data.__class__ is tracing.TracedMessage:
+				start = time.perf_counter()
+				data = data.serialize()
+				self.metrics.serialize_time += time.perf_counter() - start
+				item = (item[0], data)
+			if binary is None:
+				binary = isinstance(data, bytes)
+			elif isinstance(data, bytes) != binary:
+				self.held_item = item
+				break
+			batch.append(item)
+			size += len(data)
+			self.metrics.sent.add(item[0], len(data))
+			if size >= self.max_batch_size or item[0] in SWITCH_MESSAGES:
+				break
+			try:
+				item = self.queue.get_nowait()
+			except queue.Empty:
+				break
+		if item is None:
+			batch.append(None)
+		messages = len(batch) - (batch[-1] is None)
+		if messages:
+			self.batch_count += 1
+			self.batched_messages += messages
+			if not self.batch_count % BATCH_LOG_INTERVAL:
+				log.debug(f"{self.__class__.__name__} average batch size: {self.average_batch_size:.2f} messages")
+		return batch
+
+	@property
+	def average_batch_size(self):
+		if not self.batch_count:
+			return 0
+		return self.batched_messages / self.batch_count
+
+	def metrics_summary(self):
+		"""Returns the counters of this transport and of its callback manager as text."""
+		m = self.metrics
+		mean_serialize = m.serialize_time / m.sent.messages * 1e6 if m.sent.messages else 0
+		mean_deserialize = m.deserialize_time / m.received.messages * 1e6 if m.received.messages else 0
+		return (
+			f"{self.__class__.__name__}: connected {self.connected}, {self.successful_connects} of {m.connection_attempts} connection attempts succeeded, "
+			f"{max(self.successful_connects - 1, 0)} reconnects, {m.disconnects} disconnects\n"
+			f"sent {m.sent}, written {m.written}, in {self.batch_count} batches\n"
+			f"received {m.received}, read {m.read}\n"
+			f"send queue depth {self.queue.qsize()}, peak {self.queue.peak}, "
+			f"dropped {m.dropped} messages and {self.queue.pruned} canceled speech messages\n"
+			f"serializing {m.serialize_time:.3f} s (mean {mean_serialize:.1f} us), deserializing {m.deserialize_time:.3f} s (mean {mean_deserialize:.1f} us)\n"
+			f"callbacks: {self.callback_manager.metrics}"
+		)
+
+	def log_batch_statistics(self):
+		if self.batch_count:
+			log.info(f"{self.__class__.__name__} sent {self.batched_messages} messages in {self.batch_count} writes, average batch size {self.average_batch_size:.2f}")
+		if self.queue.pruned:
+			log.info(f"{self.__class__.__name__} dropped {self.queue.pruned} speech messages that were canceled before being sent")
+
+
+class SendQueue(queue.Queue):
+	"""FIFO queue of (type, serialized message) pairs waiting to be sent.
+	With prune_speech, queuing a cancel drops all speech queued before it that has not been sent yet,
+	so that a slow link does not play speech that is already obsolete."""
+
+	def __init__(self, prune_speech=False):
+		super().__init__()
+		self.prune_speech = prune_speech
+		self.pruned = 0
+		# Highest number of messages queued at once
+		self.peak = 0
+
+	def _put(self, item):
+		if self.prune_speech and item is not None and item[0] == 'cancel':
+			queued = len(self.queue)
+			self.queue = deque(i for i in self.queue if i is None or i[0] != 'speak')
+			self.pruned += queued - len(self.queue)
+			if self.queue and self.queue[-1] is not None and self.queue[-1][0] == 'cancel':
+				# The cancel that is already queued covers this one
+				return
+		self.queue.append(item)
+		if len(self.queue) > self.peak:
+			self.peak = len(self.queue)
+
 
 class TCPTransport(Transport):
 
-	def __init__(self, serializer, address, timeout=0):
-		super().__init__(serializer=serializer)
+	def __init__(self, serializer, address, timeout=0, max_batch_size=MAX_BATCH_SIZE, prune_speech=False, compress=False, reconnect_policy=None, heartbeat=None):
+		super().__init__(serializer=serializer, max_batch_size=max_batch_size, heartbeat=heartbeat)
+		# Compression methods offered to the server
+		self.compression_methods = compression.METHODS if compress else ()
+		self.switch_handlers['compression'] = self.start_decompression
 		self.closed = False
-		# Buffer to hold partially received data
-		self.buffer = ""
-		self.queue = queue.Queue()
+		# Holds partially received data
+		self.framer = framing.LineFramer()
+		self.stream = compression.ReceiveStream(self.framer)
+		self.queue = SendQueue(prune_speech=prune_speech)
 		self.address = address
 		self.server_sock = None
 		self.queue_thread = None
 		self.timeout = timeout
-		self.reconnector_thread = ConnectorThread(self)
+		# TLS session of the last connection, resumed by the next one
+		self.tls_session = None
+		self.reconnect_policy = reconnect_policy if reconnect_policy is not None else ReconnectPolicy()
+		self.reconnector_thread = ConnectorThread(self, policy=self.reconnect_policy)
 
 	def run(self):
 		self.closed = False
+		self.metrics.connection_attempts += 1
 		try:
-			self.server_sock = self.create_outbound_socket(self.address)
-			self.server_sock.connect(self.address)
+			server_sock = self.server_sock = self.open_connection()
 		except Exception:
 			self.callback_manager.call_callbacks('transport_connection_failed')
 			raise
+		if server_sock is None:
+			return
 		self.transport_connected()
 		self.queue_thread = threading.Thread(target=self.send_queue)
 		self.queue_thread.daemon = True
 		self.queue_thread.start()
-		while self.server_sock is not None:
+		receiving = True
+		try:
+			# Messages received along with the handshake
+			self.parse_received()
+		except ValueError:
+			receiving = False
+		# Other threads drop self.server_sock when they disconnect, the socket is closed as well then
+		while receiving and self.server_sock is server_sock:
 			try:
-				readers, writers, error = select.select([self.server_sock], [], [self.server_sock])
-			except OSError:
-				self.buffer = ""
+				readers, writers, error = select.select([server_sock], [], [server_sock])
+			except (OSError, ValueError):
+				# ValueError is raised for a socket closed meanwhile
 				break
-			if self.server_sock in error:
-				self.buffer = ""
+			if server_sock in error:
 				break
-			if self.server_sock in readers:
+			if server_sock in readers:
 				try:
-					self.handle_server_data()
-				except OSError:
-					self.buffer = ""
+					self.handle_server_data(server_sock)
+				except (OSError, ValueError):
+					# ValueError covers invalid, corrupt and too large messages
 					break
-		self.connected = False
-		self.callback_manager.call_callbacks('transport_disconnected')
+		self.stream.clear()
 		self._disconnect()
+		self.callback_manager.call_callbacks('transport_disconnected')
+
+	def open_connection(self):
+		"""Returns the connected socket, or None when the transport was closed before a connection was made."""
+		server_sock = self.create_outbound_socket(self.address)
+		server_sock.connect(self.address)
+		return server_sock
 
 	def create_outbound_socket(self, address):
 		address = socket.getaddrinfo(*address)[0]
@@ -80,69 +322,104 @@ class TCPTransport(Transport):
 			server_sock.settimeout(self.timeout)
 		server_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 		server_sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 60000, 2000))
-		server_sock = ssl.wrap_socket(server_sock)
+		# Resuming the session of the previous connection saves most of the handshake when reconnecting
+		server_sock = client_context.wrap_socket(server_sock, session=self.tls_session)
 		return server_sock
 
-	def handle_server_data(self):
-		data = self.buffer + self.server_sock.recv(16384).decode(errors="surrogatepass")
-		self.buffer = ""
-		if data == '':
+	def handle_server_data(self, server_sock):
+		data = server_sock.recv(16384)
+		if not data:
 			self._disconnect()
 			return
-		if '\n' not in data:
-			self.buffer += data
-			return
-		while '\n' in data:
-			line, sep, data = data.partition('\n')
-			self.parse(line)
-		self.buffer += data
+		self.metrics.read += len(data)
+		self.stream.feed(data)
+		self.parse_received()
 
-	def parse(self, line):
-		obj = self.serializer.deserialize(line)
-		if 'type' not in obj:
-			return
-		callback = "msg_" + obj['type']
-		del obj['type']
-		self.callback_manager.call_callbacks(callback, **obj)
+	def parse_received(self):
+		# Lines are only decoded once complete, so characters split between reads stay intact
+		with self.callback_manager.batch():
+			for line in self.stream:
+				self.parse(line.decode(errors="surrogatepass"))
+
+	def start_decompression(self, method):
+		self.stream.start_decompression(method, self.compression_methods)
+		# Compress the other direction as well, from the next batch on
+		self.send('compression', name=method)
 
 	def send_queue(self):
 		while True:
-			item = self.queue.get()
-			if item is None:
-				return
-			try:
-				self.server_sock.sendall(item.encode(errors="surrogatepass"))
-			except OSError:
+			batch = self.get_batch()
+			stop = batch[-1] is None
+			if stop:
+				batch.pop()
+			if batch:
+				data = "".join(data for type, data in batch).encode(errors="surrogatepass")
+				if self.compressor is not None:
+					data = self.compressor.compress_batch(data)
+				try:
+					self.server_sock.sendall(data)
+				except OSError:
+					return
+				self.metrics.written += len(data)
+				if batch[-1][0] == 'compression':
+					self.compressor = compression.Compressor()
+			if stop:
 				return
 
 	def send(self, type, **kwargs):
-		obj = self.serializer.serialize(type=type, **kwargs)
-		if self.connected:
-			self.queue.put(obj)
+		with self.send_lock:
+			obj = self.serialize(type, kwargs)
+			if self.connected:
+				self.queue.put((type, obj))
+			else:
+				self.metrics.dropped += 1
 
 	def _disconnect(self):
 		"""Disconnect the transport due to an error, without closing the connector thread."""
 		if not self.connected:
 			return
+		self.connected = False
+		self.metrics.disconnects += 1
+		self.heartbeat.stop()
+		# The receiving thread and close may both get here when the other end leaves as the transport is closed
+		server_sock, self.server_sock = self.server_sock, None
+		if server_sock is not None:
+			# With TLS 1.3, the session can only be resumed once its ticket has been received after the handshake,
+			# so it is taken when the connection ends
+			try:
+				self.tls_session = getattr(server_sock, 'session', None)
+			except ValueError:
+				# OpenSSL fails to encode sessions that can't be resumed, the next connection starts a new one
+				self.tls_session = None
+			try:
+				# Wakes up the receiving thread, which closing alone doesn't do on every platform,
+				# and the send queue, which blocks in sendall when the other end stopped reading
+				server_sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
 		if self.queue_thread is not None:
 			self.queue.put(None)
 			self.queue_thread.join()
-		clear_queue(self.queue)
-		self.server_sock.close()
-		self.server_sock = None
+		if server_sock is not None:
+			server_sock.close()
+		self.metrics.dropped += clear_queue(self.queue)
+		self.held_item = None
+		self.compressor = None
+		self.log_batch_statistics()
 
 	def close(self):
 		self.callback_manager.call_callbacks('transport_closing')
-		self.reconnector_thread.running = False
+		self.reconnector_thread.stop()
 		self._disconnect()
 		self.closed = True
-		self.reconnector_thread = ConnectorThread(self)
+		self.reconnector_thread = ConnectorThread(self, policy=self.reconnect_policy)
 
 
 class RelayTransport(TCPTransport):
+	RELAY_PONGS_ONLY = True
 
-	def __init__(self, serializer, address, timeout=0, channel=None, connection_type=None, protocol_version=PROTOCOL_VERSION):
-		super().__init__(address=address, serializer=serializer, timeout=timeout)
+	def __init__(self, serializer, address, timeout=0, channel=None, connection_type=None, protocol_version=PROTOCOL_VERSION, max_batch_size=MAX_BATCH_SIZE, prune_speech=False, compress=False, reconnect_policy=None, heartbeat=None):
+		super().__init__(address=address, serializer=serializer, timeout=timeout, max_batch_size=max_batch_size, prune_speech=prune_speech, compress=compress, reconnect_policy=reconnect_policy, heartbeat=heartbeat)
 		log.info(f"Connecting to {address} channel {channel}")
 		self.channel = channel
 		self.connection_type = connection_type
@@ -150,17 +427,125 @@ class RelayTransport(TCPTransport):
 		self.callback_manager.register_callback('transport_connected', self.on_connected)
 
 	def on_connected(self):
-		self.send('protocol_version', version=self.protocol_version)
+		self.send('protocol_version', version=self.protocol_version, compression=list(self.compression_methods))
 		if self.channel is not None:
 			self.send('join', channel=self.channel, connection_type=self.connection_type)
 		else:
 			self.send('generate_key')
 
 
+class LocalTransport(RelayTransport):
+	"""Connects the NVDA instance on the secure desktop to the LocalListenerTransport of the instance on the user desktop.
+	The connection is a plain loopback socket, the listener is joined with its token as channel."""
+	# The listener answers pings itself
+	RELAY_PONGS_ONLY = False
+
+	def create_outbound_socket(self, address):
+		server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		if self.timeout:
+			server_sock.settimeout(self.timeout)
+		server_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		return server_sock
+
+
+class LocalListenerTransport(TCPTransport):
+	"""Accepts the connection of the NVDA instance on the secure desktop on a loopback socket.
+	It speaks the relay protocol as if the other end joined a relay channel named token,
+	without TLS and without a relay server in between.
+	Connections that don't join with the token are closed."""
+	HANDSHAKE_TIMEOUT = 10
+	# Interval at which a pending accept checks whether the transport was closed
+	ACCEPT_INTERVAL = 1
+	# Client ids of the listener and of the connected instance, as a relay server would assign them
+	LISTENER_ID = 1
+	CLIENT_ID = 2
+
+	def __init__(self, serializer, token, max_batch_size=MAX_BATCH_SIZE, prune_speech=False, heartbeat=None):
+		# Waiting for a connection is done by accept, so the next connection is accepted right after one ends,
+		# however short it was, and there is no server to spare when accepting fails
+		reconnect_policy = ReconnectPolicy(initial_delay=0.1, max_delay=1, stable_time=0)
+		super().__init__(serializer=serializer, address=None, max_batch_size=max_batch_size, prune_speech=prune_speech, reconnect_policy=reconnect_policy, heartbeat=heartbeat)
+		self.token = token
+		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listen_socket.bind(('127.0.0.1', 0))
+		self.listen_socket.listen(1)
+		self.listen_socket.settimeout(self.ACCEPT_INTERVAL)
+		self.address = self.listen_socket.getsockname()
+		self.client = None
+
+	def open_connection(self):
+		while not self.closed:
+			try:
+				client_sock, address = self.listen_socket.accept()
+			except socket.timeout:
+				continue
+			except OSError:
+				if self.closed:
+					return None
+				raise
+			try:
+				joined = self.accept_join(client_sock)
+			except Exception:
+				# Any local process can connect, whatever it sends only rejects its connection
+				log.debugWarning("Invalid handshake on the secure desktop link", exc_info=True)
+				joined = False
+			if joined:
+				client_sock.settimeout(None)
+				client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+				return client_sock
+			log.warning(f"Rejected connection to the secure desktop link from {address}")
+			client_sock.close()
+			self.framer.clear()
+		return None
+
+	def accept_join(self, client_sock):
+		"""Reads the handshake of a new connection, which must be complete within HANDSHAKE_TIMEOUT seconds.
+		Returns whether it joined with the token."""
+		# A single deadline for the whole handshake, so a connection sending a byte now and then can't hold the listener
+		deadline = time.monotonic() + self.HANDSHAKE_TIMEOUT
+		while True:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				return False
+			client_sock.settimeout(remaining)
+			data = client_sock.recv(16384)
+			if not data:
+				return False
+			self.framer.feed(data)
+			for line in self.framer:
+				obj = self.serializer.deserialize(line.decode(errors="surrogatepass"))
+				if not isinstance(obj, dict):
+					return False
+				type = obj.get('type')
+				if type == 'protocol_version' or type in HEARTBEAT_MESSAGES:
+					continue
+				# Compared as bytes, compare_digest rejects strings with characters other than ASCII
+				channel = str(obj.get('channel')).encode(errors="surrogatepass")
+				if type != 'join' or not hmac.compare_digest(channel, self.token.encode()):
+					return False
+				self.client = dict(id=self.CLIENT_ID, connection_type=obj.get('connection_type'))
+				return True
+
+	def transport_connected(self):
+		super().transport_connected()
+		listener = dict(id=self.LISTENER_ID, connection_type=None)
+		self.send('channel_joined', channel=self.token, user_ids=[self.LISTENER_ID], clients=[listener])
+		self.callback_manager.call_callbacks('msg_client_joined', user_id=self.CLIENT_ID, client=self.client)
+
+	def reset(self, token):
+		"""Drops the connected instance, if any. From now on, only connections joining with token are accepted."""
+		self.token = token
+		self._disconnect()
+
+	def close(self):
+		super().close()
+		self.listen_socket.close()
+
+
 class DVCTransport(Transport, unicorn.UnicornCallbackHandler):
 
-	def __init__(self, serializer, timeout=60, connection_type=None, protocol_version=PROTOCOL_VERSION):
-		Transport.__init__(self, serializer=serializer)
+	def __init__(self, serializer, timeout=60, connection_type=None, protocol_version=PROTOCOL_VERSION, max_batch_size=MAX_BATCH_SIZE, prune_speech=False, serializers=tuple(SERIALIZERS), compress=False, reconnect_policy=None, heartbeat=None):
+		Transport.__init__(self, serializer=serializer, max_batch_size=max_batch_size, heartbeat=heartbeat)
 		unicorn.UnicornCallbackHandler.__init__(self)
 		if connection_type not in DVCTYPES:
 			raise ValueError("Unsupported connection type for DVC connection")
@@ -168,17 +553,29 @@ class DVCTransport(Transport, unicorn.UnicornCallbackHandler):
 		self.lib = unicorn.Unicorn(DVCTYPES.index(connection_type), self)
 		self.opened = False
 		self.initialized = False
-		# Buffer to hold partially received data
-		self.buffer = ""
-		self.queue = queue.Queue()
+		# Holds partially received data
+		self.framer = framing.TextLineFramer()
+		self.binary_framer = framing.LengthPrefixFramer()
+		self.queue = SendQueue(prune_speech=prune_speech)
 		self.queue_thread = None
+		# The serializer every connection starts with, and the names of the serializers that may be negotiated
+		self.default_serializer = serializer
+		self.serializers = serializers
+		self.compression_methods = compression.METHODS if compress else ()
+		# Decodes the text received after decompression, which may end in the middle of a character
+		self.text_decoder = None
+		self.switch_handlers['serializer'] = self.set_inbound_serializer
+		self.switch_handlers['compression'] = self.start_decompression
+		# Reused for every write, grown when a batch doesn't fit
+		self.write_buffer = (ctypes.c_byte * 0)()
 		self.interrupt_event = threading.Event()
 		self.timeout = timeout
-		self.reconnector_thread = ConnectorThread(self, run_except=EnvironmentError)
+		self.reconnect_policy = reconnect_policy if reconnect_policy is not None else ReconnectPolicy()
+		self.reconnector_thread = ConnectorThread(self, policy=self.reconnect_policy, run_except=EnvironmentError)
 		self.connection_type = connection_type
 		self.protocol_version = protocol_version
 		self.callback_manager.register_callback('msg_protocol_version', self.handle_p2p)
-		self	.initialize_lib()
+		self.initialize_lib()
 
 	def initialize_lib(self):
 		if self.initialized:
@@ -198,6 +595,7 @@ class DVCTransport(Transport, unicorn.UnicornCallbackHandler):
 
 	def run(self):
 		self.interrupt_event.clear()
+		self.metrics.connection_attempts += 1
 		res = self.lib.Open()
 		if res >= 1 << 31:
 			raise OSError("Raised WinError %s out of range" % hex(res))
@@ -217,47 +615,113 @@ class DVCTransport(Transport, unicorn.UnicornCallbackHandler):
 		self.callback_manager.call_callbacks('transport_disconnected')
 		self._disconnect()
 
-	def handle_data(self, string):
-		data = self.buffer + string
-		self.buffer = ""
-		if data == '':
-			self._disconnect()
+	def handle_data(self, data):
+		if self.decompressor is None:
+			self.receive_data(data)
 			return
-		if '\n' not in data:
-			self.buffer += data
+		try:
+			# Decompressed in pieces of the maximum message size, so a message inflating beyond it
+			# is rejected before the rest of it is decompressed
+			for chunk in self.decompressor.decompress_chunks(data, self.binary_framer.max_message_size):
+				if not self.inbound_serializer.binary:
+					chunk = self.text_decoder.decode(chunk)
+				self.receive_data(chunk)
+				if self.interrupt_event.is_set():
+					return
+		except ValueError:
+			log.warning("Invalid compressed data received over DVC", exc_info=True)
+			self.interrupt_event.set()
+
+	def receive_data(self, data):
+		if self.inbound_serializer.binary:
+			framer = self.binary_framer
+		else:
+			framer = self.framer
+			# Every text write is terminated by a null character
+			if "\x00" in data:
+				data = data.replace("\x00", "")
+		framer.feed(data)
+		try:
+			with self.callback_manager.batch():
+				for message in framer:
+					self.parse(message)
+		except framing.MessageTooLargeError:
+			log.warning("Message received over DVC exceeds the maximum message size", exc_info=True)
+			framer.clear()
+			self.interrupt_event.set()
+		except ValueError:
+			# Raising would end up in the native callback, the connection is dropped instead
+			log.warning("Invalid message received over DVC", exc_info=True)
+			framer.clear()
+			self.interrupt_event.set()
+
+	def set_inbound_serializer(self, name):
+		if name not in SERIALIZERS:
+			log.warning(f"Remote end switched to unsupported serializer {name!r}")
+			self.interrupt_event.set()
 			return
-		while '\n' in data:
-			line, sep, data = data.partition('\n')
-			self.parse(line)
-		self.buffer += data
-
-	def parse(self, line):
-		obj = self.serializer.deserialize(line)
-		if 'type' not in obj:
+		log.debug(f"Receiving messages serialized by {name} serializer")
+		# The switch is the last message of its write, anything left is unusable
+		self.framer.clear()
+		self.binary_framer.clear()
+		self.inbound_serializer = SERIALIZERS[name]()
+
+	def start_decompression(self, method):
+		if method not in self.compression_methods or self.decompressor is not None:
+			log.warning(f"Remote end switched to unexpected compression method {method!r}")
+			self.interrupt_event.set()
 			return
-		callback = "msg_" + obj['type']
-		del obj['type']
-		self.callback_manager.call_callbacks(callback, **obj)
+		log.debug(f"Receiving messages compressed with {method}")
+		self.framer.clear()
+		self.binary_framer.clear()
+		self.decompressor = compression.Decompressor()
+		self.text_decoder = codecs.getincrementaldecoder('utf-8')('surrogatepass')
 
 	def send_queue(self):
 		while True:
-			item = self.queue.get()
-			if item is None:
+			batch = self.get_batch()
+			stop = batch[-1] is None
+			if stop:
+				batch.pop()
+			if batch:
+				data = [data for type, data in batch]
+				self.write(b"".join(data) if isinstance(data[0], bytes) else "".join(data))
+				if batch[-1][0] == 'compression':
+					self.compressor = compression.Compressor()
+			if stop:
 				return
-			strbuf = ctypes.create_unicode_buffer(item)
-			res = self.lib.Write(ctypes.sizeof(strbuf), ctypes.cast(strbuf, ctypes.POINTER(ctypes.wintypes.BYTE)))
-			if res:
-				log.warning(ctypes.WinError(res))
-				# return
+
+	def write(self, data):
+		if self.compressor is not None:
+			if isinstance(data, str):
+				data = data.encode(errors="surrogatepass")
+			data = self.compressor.compress_batch(data)
+		elif isinstance(data, str):
+			# The receiving end expects text as null terminated UTF-16, like a unicode buffer
+			data = (data + "\x00").encode("utf-16-le", errors="surrogatepass")
+		size = len(data)
+		self.metrics.written += size
+		if size > ctypes.sizeof(self.write_buffer):
+			self.write_buffer = (ctypes.c_byte * size)()
+		ctypes.memmove(self.write_buffer, data, size)
+		res = self.lib.Write(size, ctypes.cast(self.write_buffer, ctypes.POINTER(ctypes.wintypes.BYTE)))
+		if res:
+			log.warning(ctypes.WinError(res))
 
 	def send(self, type, origin=None, **kwargs):
-		obj = self.serializer.serialize(type=type, origin=origin or -1, **kwargs)
-		if self.connected:
-			self.queue.put(obj)
+		with self.send_lock:
+			kwargs['origin'] = origin or -1
+			obj = self.serialize(type, kwargs)
+			if self.connected:
+				self.queue.put((type, obj))
+			else:
+				self.metrics.dropped += 1
 
 	def _disconnect(self):
 		if not self.connected and not self.opened:
 			return
+		self.metrics.disconnects += 1
+		self.heartbeat.stop()
 		self.interrupt_event.set()
 		# Closing in this context is the equivalent for disconnecting the transport
 		res = self.lib.Close()
@@ -266,25 +730,53 @@ class DVCTransport(Transport, unicorn.UnicornCallbackHandler):
 		if self.queue_thread is not None:
 			self.queue.put(None)
 			self.queue_thread.join()
-		clear_queue(self.queue)
+		self.metrics.dropped += clear_queue(self.queue)
+		self.held_item = None
+		self.log_batch_statistics()
+		self.framer.clear()
+		self.binary_framer.clear()
+		self.serializer = self.inbound_serializer = self.default_serializer
+		self.compressor = self.decompressor = self.text_decoder = None
 		self.connected = False
 		self.opened = False
 
 	def close(self):
 		self.callback_manager.call_callbacks('transport_closing')
-		self.reconnector_thread.running = False
+		self.reconnector_thread.stop()
 		self._disconnect()
 		# Terminating in this context is the equivalent for closing the transport
 		res = self.terminate_lib()
 		if res:
 			raise ctypes.WinError(res)
-		self.reconnector_thread = ConnectorThread(self, run_except=EnvironmentError)
+		self.reconnector_thread = ConnectorThread(self, policy=self.reconnect_policy, run_except=EnvironmentError)
 
-	def handle_p2p(self, version, **kwargs):
+	def handle_p2p(self, version, serializers=None, **kwargs):
 		if version == PROTOCOL_VERSION:
 			self.send(type='client_joined', client=dict(id=-1, connection_type=self.connection_type))
 		else:
 			self.send(type='version_mismatch')
+			return
+		method = compression.negotiate(self.compression_methods, kwargs.get('compression') or ())
+		self.negotiate_serializer(serializers or (), compressed=method is not None)
+		if method is not None:
+			log.debug(f"Sending messages compressed with {method}")
+			# The send queue compresses everything after this message
+			self.send('compression', name=method)
+
+	def negotiate_serializer(self, remote_serializers, compressed=False):
+		"""Switches to the most preferred serializer the remote end supports as well.
+		Without compression, binary serializers are preferred, since their smaller messages outweigh their slower decoding.
+		The remote end is told before the switch, so the messages before it are still understood."""
+		names = self.serializers
+		if not compressed:
+			names = sorted(names, key=lambda name: not SERIALIZERS[name].binary)
+		name = next((name for name in names if name in remote_serializers), None)
+		if name is None or name == self.serializer.name:
+			return
+		log.debug(f"Sending messages serialized by {name} serializer")
+		with self.send_lock:
+			self.send('serializer', name=name)
+			self.serializer = SERIALIZERS[name]()
 
 	def _Connected(self):
 		log.info("Connected to remote protocol server")
@@ -303,16 +795,16 @@ class DVCTransport(Transport, unicorn.UnicornCallbackHandler):
 	def _OnNewChannelConnection(self):
 		log.info("DVC connection initiated from remote protocol server")
 		self.transport_connected()
-		self.send('protocol_version', version=self.protocol_version)
+		self.send('protocol_version', version=self.protocol_version, serializers=list(self.serializers), compression=list(self.compression_methods))
 		return 0
 
 	def _OnDataReceived(self, cbSize, pBuffer):
-		pBuffer = ctypes.cast(pBuffer, ctypes.POINTER(ctypes.c_wchar * (cbSize // ctypes.sizeof(ctypes.c_wchar))))
-		string = "".join(pBuffer.contents)
-		if "\x00" not in string:
-			self.buffer += string
+		self.metrics.read += cbSize
+		# Copy the native buffer at once, rather than creating an object per character
+		if self.inbound_serializer.binary or self.decompressor is not None:
+			self.handle_data(ctypes.string_at(pBuffer, cbSize))
 		else:
-			self.handle_data(string.replace("\x00", ""))
+			self.handle_data(ctypes.wstring_at(pBuffer, cbSize // ctypes.sizeof(ctypes.c_wchar)))
 		return 0
 
 	def _OnReadError(self, dwError):
@@ -326,6 +818,11 @@ class DVCTransport(Transport, unicorn.UnicornCallbackHandler):
 		self._disconnect()
 		return 0
 
+	def on_heartbeat_timeout(self):
+		# The other end is gone as if it closed the channel
+		self.callback_manager.call_callbacks('msg_client_left', client=dict(id=-1))
+		self._disconnect()
+
 	def _OnTrial(self):
 		core.callLater(2000, self.callback_manager.call_callbacks, 'transport_connection_in_trial_mode')
 
@@ -333,33 +830,80 @@ class DVCTransport(Transport, unicorn.UnicornCallbackHandler):
 		self.callback_manager.call_callbacks('transport_trial_expired')
 
 
+class ReconnectPolicy:
+	"""Decides how long to wait before connecting again.
+	After a connection that was established for at least stable_time seconds, the first attempt is made right away.
+	Every failed attempt after that waits multiplier times longer, from initial_delay up to max_delay.
+	Each delay is shortened by a random part of up to jitter times its length,
+	so clients disconnected at the same time, such as by a relay restart, don't reconnect in lockstep."""
+
+	def __init__(self, initial_delay=0.5, max_delay=30, multiplier=2, jitter=0.5, stable_time=10):
+		self.initial_delay = initial_delay
+		self.max_delay = max_delay
+		self.multiplier = multiplier
+		self.jitter = jitter
+		self.stable_time = stable_time
+
+	def get_delay(self, failures):
+		"""Returns the seconds to wait before the next attempt, after failures attempts that did not result in a stable connection."""
+		if not failures:
+			return 0
+		delay = min(self.max_delay, self.initial_delay * self.multiplier ** (failures - 1))
+		return delay * (1 - self.jitter * random.random())
+
+
 class ConnectorThread(threading.Thread):
 
-	def __init__(self, connector, connect_delay=5, run_except=socket.error):
+	def __init__(self, connector, policy=None, run_except=socket.error):
 		super().__init__()
-		self.connect_delay = connect_delay
+		self.policy = policy if policy is not None else ReconnectPolicy()
 		self.run_except = run_except
 		self.running = True
 		self.connector = connector
+		# Number of attempts since the last stable connection
+		self.failures = 0
+		# Set to end the wait before the next attempt
+		self.wake_event = threading.Event()
 		self.name = self.name + "_connector_loop"
 		self.daemon = True
 
 	def run(self):
 		while self.running:
+			connects = self.connector.successful_connects
+			start = time.monotonic()
 			try:
 				self.connector.run()
 			except self.run_except:
 				log.debugWarning("Connection failed", exc_info=True)
-				time.sleep(self.connect_delay)
-				continue
+			if self.connector.successful_connects > connects and time.monotonic() - start >= self.policy.stable_time:
+				self.failures = 0
 			else:
-				time.sleep(self.connect_delay)
+				self.failures += 1
+			delay = self.policy.get_delay(self.failures)
+			if delay and self.running:
+				log.debug(f"Connecting again in {delay:.1f} seconds")
+				self.wake_event.wait(delay)
+				self.wake_event.clear()
 		log.info("Ending control connector thread %s" % self.name)
 
+	def retry_now(self):
+		"""Ends the wait before the next attempt, which starts without backing off further."""
+		self.failures = 0
+		self.wake_event.set()
+
+	def stop(self):
+		"""Ends the thread once the current attempt is over, without waiting for the next one."""
+		self.running = False
+		self.wake_event.set()
+
 
 def clear_queue(queue):
+	"""Empties queue, returns the number of messages it held."""
+	count = 0
 	try:
 		while True:
-			queue.get_nowait()
+			if queue.get_nowait() is not None:
+				count += 1
 	except Exception:
 		pass
+	return count
@@ -0,0 +1,28 @@
+"""Microbenchmarks for the hot paths of the UnicornDVC add-on.
+
+Run a benchmark from the root of the repository, e.g. python -m benchmarks.server_loop
+The suite module times all hot paths at once and saves the results as JSON, see python -m benchmarks.suite --help
+"""
+
+import importlib
+import os
+import sys
+import types
+
+ADDON_PACKAGE = 'unicorn'
+ADDON_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'addon', 'globalPlugins', ADDON_PACKAGE)
+# Lightweight stand-ins for the NVDA modules the add-on imports
+STUBS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+
+def import_addon_module(name):
+	"""Imports a module of the add-on without executing the global plugin's __init__,
+	which requires a running NVDA.
+	NVDA modules that can not be imported are replaced by the stand-ins in the stubs directory."""
+	if STUBS_PATH not in sys.path:
+		sys.path.append(STUBS_PATH)
+	if ADDON_PACKAGE not in sys.modules:
+		package = types.ModuleType(ADDON_PACKAGE)
+		package.__path__ = [ADDON_PATH]
+		sys.modules[ADDON_PACKAGE] = package
+	return importlib.import_module(f"{ADDON_PACKAGE}.{name}")
@@ -0,0 +1,46 @@
+"""Measures forwarding speech from the secure desktop relay to the slave transport through BridgeTransport,
+with messages decoded and serialized again, and passed on as they were received."""
+
+import time
+from . import import_addon_module
+
+bridge = import_addon_module('bridge')
+serializer = import_addon_module('serializer')
+transport = import_addon_module('transport')
+
+MESSAGES = 2000
+
+
+def create_transport(serializer):
+	result = transport.TCPTransport.__new__(transport.TCPTransport)
+	transport.Transport.__init__(result, serializer=serializer)
+	result.queue = transport.SendQueue()
+	result.connected = True
+	return result
+
+
+def run(raw, destination_serializer):
+	source = create_transport(serializer.JSONSerializer())
+	destination = create_transport(destination_serializer)
+	bridge.BridgeTransport(destination, source, raw=raw)
+	lines = [
+		source.serializer.serialize(type='speak', sequence=[f"Password, edit, protected, {i}"], priority=0)[:-1]
+		for i in range(MESSAGES)
+	]
+	start = time.perf_counter()
+	for line in lines:
+		source.parse(line)
+	elapsed = time.perf_counter() - start
+	assert destination.queue.qsize() == MESSAGES
+	return elapsed / MESSAGES
+
+
+def main():
+	for name, cls in serializer.SERIALIZERS.items():
+		decoded = run(False, cls())
+		raw = run(True, cls())
+		print(f"to {name:>6} transport: decoded {decoded * 1e6:.1f} us, raw {raw * 1e6:.1f} us per message")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,65 @@
+"""Counts the main thread wake ups needed to dispatch a burst of received messages,
+for a slave whose session handles speech and which forwards everything to the secure desktop."""
+
+import contextlib
+import time
+from collections import defaultdict
+from . import import_addon_module
+
+callback_manager = import_addon_module('callback_manager')
+import wx
+
+MESSAGE_COUNTS = (1, 10, 100)
+
+
+class LegacyCallbackManager:
+	"""The dispatch as it was before: one CallAfter for every callback of every event."""
+
+	def __init__(self):
+		self.callbacks = defaultdict(list)
+
+	def register_callback(self, event_type, callback, thread_safe=False):
+		self.callbacks[event_type].append(callback)
+
+	def call_callbacks(self, type, *args, **kwargs):
+		for callback in self.callbacks[type]:
+			wx.CallAfter(callback, *args, **kwargs)
+		for callback in self.callbacks['*']:
+			wx.CallAfter(callback, type, *args, **kwargs)
+
+	def batch(self):
+		# The legacy manager has no batches
+		return contextlib.nullcontext()
+
+
+def create_manager(cls, received):
+	manager = cls()
+	manager.register_callback('msg_speak', lambda **kwargs: received.append('speak'))
+	manager.register_callback('msg_speak', lambda **kwargs: None)
+	# BridgeTransport forwarding to the secure desktop
+	manager.register_callback('*', lambda type, **kwargs: received.append(type), thread_safe=True)
+	return manager
+
+
+def run(cls, count):
+	received = []
+	manager = create_manager(cls, received)
+	start = time.perf_counter()
+	with manager.batch():
+		for i in range(count):
+			manager.call_callbacks('msg_speak', sequence=[f"Line {i}"], priority=0)
+	wakeups = wx.process_pending_calls()
+	elapsed = time.perf_counter() - start
+	assert received.count('speak') == count and received.count('msg_speak') == count
+	return {'wakeups': wakeups, 'time': elapsed}
+
+
+def main():
+	for count in MESSAGE_COUNTS:
+		legacy = run(LegacyCallbackManager, count)
+		current = run(callback_manager.CallbackManager, count)
+		print(f"{count:>4} messages: legacy {legacy['wakeups']} main thread calls, {legacy['time'] * 1e6:.0f} us; current {current['wakeups']} main thread calls, {current['time'] * 1e6:.0f} us")
+
+
+if __name__ == '__main__':
+	main()
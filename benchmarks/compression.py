@@ -0,0 +1,59 @@
+"""Measures the DVC traffic of a typical browsing session with and without streaming compression.
+Each batch is compressed and flushed on its own, as the send queue does."""
+
+import random
+import time
+from . import import_addon_module
+
+compression = import_addon_module('compression')
+serializer = import_addon_module('serializer')
+
+BATCHES = 500
+
+
+def create_batches(instance, count=BATCHES):
+	"""Returns batches of a speech message and a braille frame of a 40 cell display, as sent when moving through a list."""
+	rng = random.Random(0)
+	cells = [0] * 40
+	batches = []
+	for i in range(count):
+		text = f"Item {i} of {count}, {rng.choice(('not selected', 'selected', 'expanded', 'collapsed'))}"
+		cells[:len(text)] = [ord(char) % 64 for char in text[:40]]
+		batch = [
+			instance.serialize(type='cancel'),
+			instance.serialize(type='speak', sequence=[text], priority=0),
+			instance.serialize(type='display', cells=cells),
+		]
+		if instance.binary:
+			batches.append(b"".join(batch))
+		else:
+			batches.append("".join(batch))
+	return batches
+
+
+def run():
+	results = {}
+	for name, cls in serializer.SERIALIZERS.items():
+		batches = create_batches(cls())
+		if cls.binary:
+			raw = batches
+			raw_size = sum(len(batch) for batch in raw)
+		else:
+			# Uncompressed text is written as null terminated UTF-16, compressed text as UTF-8
+			raw_size = sum(len((batch + "\x00").encode('utf-16-le')) for batch in batches)
+			raw = [batch.encode() for batch in batches]
+		compressor = compression.Compressor()
+		start = time.perf_counter()
+		compressed_size = sum(len(compressor.compress_batch(batch)) for batch in raw)
+		elapsed = time.perf_counter() - start
+		results[name] = {'raw': raw_size, 'compressed': compressed_size, 'time_per_batch': elapsed / len(raw)}
+	return results
+
+
+def main():
+	for name, result in run().items():
+		print(f"{name:>6}: {result['raw']} bytes uncompressed, {result['compressed']} bytes compressed ({result['raw'] / result['compressed']:.1f}x), {result['time_per_batch'] * 1e6:.1f} us per batch")
+
+
+if __name__ == '__main__':
+	main()
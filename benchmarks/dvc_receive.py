@@ -0,0 +1,103 @@
+"""Measures the DVC receive path with a simulated native callback buffer.
+A burst of speech and braille messages is written as one null terminated wide character buffer,
+and handed to _OnDataReceived in chunks, as the UnicornDVC library does."""
+
+import ctypes
+import json
+import threading
+import time
+from . import import_addon_module
+
+callback_manager = import_addon_module('callback_manager')
+metrics = import_addon_module('metrics')
+framing = import_addon_module('framing')
+serializer = import_addon_module('serializer')
+transport = import_addon_module('transport')
+
+CHUNK_SIZE = 1600
+MESSAGE_COUNTS = (10, 100, 1000)
+
+
+class LegacyReceiver:
+	"""The receive path as it was before: one str per UTF-16 code unit."""
+
+	def __init__(self):
+		self.buffer = ""
+		self.lines = []
+
+	def _OnDataReceived(self, cbSize, pBuffer):
+		pBuffer = ctypes.cast(pBuffer, ctypes.POINTER(ctypes.c_wchar * (cbSize // ctypes.sizeof(ctypes.c_wchar))))
+		string = "".join(pBuffer.contents)
+		if "\x00" not in string:
+			self.buffer += string
+		else:
+			self.handle_data(string.replace("\x00", ""))
+		return 0
+
+	def handle_data(self, string):
+		data = self.buffer + string
+		self.buffer = ""
+		while '\n' in data:
+			line, sep, data = data.partition('\n')
+			self.lines.append(line)
+		self.buffer += data
+
+
+def create_receiver():
+	receiver = transport.DVCTransport.__new__(transport.DVCTransport)
+	receiver.framer = framing.TextLineFramer()
+	receiver.inbound_serializer = serializer.JSONSerializer()
+	receiver.decompressor = None
+	receiver.callback_manager = callback_manager.CallbackManager()
+	receiver.metrics = metrics.TransportMetrics()
+	receiver.interrupt_event = threading.Event()
+	receiver.lines = []
+	receiver.parse = receiver.lines.append
+	return receiver
+
+
+def create_burst(count):
+	messages = []
+	for i in range(count):
+		if i % 2:
+			message = dict(type='display', cells=[(i + cell) % 256 for cell in range(80)])
+		else:
+			message = dict(type='speak', sequence=[f"List item {i} of {count}, not selected"], priority=0)
+		messages.append(json.dumps(message) + "\n")
+	return ctypes.create_unicode_buffer("".join(messages))
+
+
+def deliver(receiver, buffer):
+	size = ctypes.sizeof(buffer)
+	address = ctypes.addressof(buffer)
+	for offset in range(0, size, CHUNK_SIZE):
+		pBuffer = ctypes.cast(address + offset, ctypes.POINTER(ctypes.wintypes.BYTE))
+		receiver._OnDataReceived(min(CHUNK_SIZE, size - offset), pBuffer)
+	return receiver.lines
+
+
+def best_of(factory, buffer, repeat=5):
+	best = None
+	for i in range(repeat):
+		receiver = factory()
+		start = time.perf_counter()
+		deliver(receiver, buffer)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def run(count):
+	buffer = create_burst(count)
+	assert deliver(LegacyReceiver(), buffer) == deliver(create_receiver(), buffer)
+	return {'messages': count, 'bytes': ctypes.sizeof(buffer), 'legacy': best_of(LegacyReceiver, buffer), 'current': best_of(create_receiver, buffer)}
+
+
+def main():
+	for count in MESSAGE_COUNTS:
+		result = run(count)
+		print(f"{count:>5} messages ({result['bytes']} bytes): legacy {result['legacy'] * 1000:.2f} ms, current {result['current'] * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+	main()
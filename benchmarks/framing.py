@@ -0,0 +1,77 @@
+"""Measures line framing of large say-all speech messages arriving in small chunks."""
+
+import json
+import time
+from . import import_addon_module
+
+framing = import_addon_module('framing')
+
+CHUNK_SIZE = 1400
+MESSAGE_SIZES = (16 * 1024, 256 * 1024, 1024 * 1024)
+SENTENCE = "The quick brown fox jumps over the lazy dog, naïvely reading the café menu. "
+
+
+def say_all_message(size):
+	sentences = []
+	length = 0
+	while length < size:
+		sentences.append(SENTENCE)
+		length += len(SENTENCE)
+	return (json.dumps(dict(type='speak', sequence=sentences, priority=0)) + "\n").encode()
+
+
+def chunked(data):
+	return [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+
+def frame_str(chunks):
+	"""The framing as it was done before the LineFramer: decode every chunk and prepend the buffer."""
+	buffer = ""
+	lines = []
+	for chunk in chunks:
+		data = buffer + chunk.decode(errors="surrogatepass")
+		if '\n' not in data:
+			buffer = data
+			continue
+		buffer = ""
+		while '\n' in data:
+			line, sep, data = data.partition('\n')
+			lines.append(line)
+		buffer += data
+	return lines
+
+
+def frame_bytes(chunks):
+	framer = framing.LineFramer(max_message_size=16 * 1024 * 1024)
+	lines = []
+	for chunk in chunks:
+		framer.feed(chunk)
+		for line in framer:
+			lines.append(line.decode(errors="surrogatepass"))
+	return lines
+
+
+def best_of(func, chunks, repeat=5):
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		func(chunks)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+
+def run(size):
+	chunks = chunked(say_all_message(size))
+	assert frame_str(chunks) == frame_bytes(chunks)
+	return {'message_size': size, 'chunks': len(chunks), 'str': best_of(frame_str, chunks), 'bytes': best_of(frame_bytes, chunks)}
+
+
+def main():
+	for size in MESSAGE_SIZES:
+		result = run(size)
+		print(f"{size // 1024:>5} KiB in {result['chunks']} chunks: str {result['str'] * 1000:.2f} ms, bytes {result['bytes'] * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+	main()
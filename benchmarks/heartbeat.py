@@ -0,0 +1,62 @@
+"""Measures how long a transport takes to notice that the other end stopped answering while the connection stays open,
+as when the other computer hangs or a network path is lost without a reset.
+
+Without the heartbeat such a connection stayed up until TCP keepalive gave up,
+which only runs on Windows and takes over a minute with the settings the transport uses.
+"""
+
+import threading
+import time
+import uuid
+from . import import_addon_module
+
+heartbeat = import_addon_module('heartbeat')
+serializer = import_addon_module('serializer')
+transport = import_addon_module('transport')
+import wx
+
+INTERVAL = 0.2
+MAX_MISSED = 3
+ROUND_TRIPS = 20
+
+
+class HangingListener(transport.LocalListenerTransport):
+	"""Stops reading from its connection when hang is set, so pings are no longer answered."""
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.hang = threading.Event()
+
+	def handle_server_data(self, server_sock):
+		if self.hang.is_set():
+			time.sleep(INTERVAL)
+			return
+		super().handle_server_data(server_sock)
+
+
+def main():
+	token = str(uuid.uuid4())
+	listener = HangingListener(serializer=serializer.JSONSerializer(), token=token, heartbeat=heartbeat.Heartbeat(interval=3600))
+	listener.reconnector_thread.start()
+	client_heartbeat = heartbeat.Heartbeat(interval=INTERVAL, max_missed=MAX_MISSED)
+	client = transport.LocalTransport(address=listener.address, serializer=serializer.JSONSerializer(), channel=token, connection_type='slave', heartbeat=client_heartbeat)
+	disconnected = threading.Event()
+	client.callback_manager.register_callback('transport_disconnected', disconnected.set, thread_safe=True)
+	client.reconnector_thread.start()
+	end = time.perf_counter() + INTERVAL * ROUND_TRIPS
+	while time.perf_counter() < end:
+		# Runs the calls made to the main thread, such as the join sent once connected
+		wx.process_pending_calls()
+		time.sleep(0.01)
+	print(f"loopback round trip time {client_heartbeat.rtt * 1e6:.0f} us, jitter {client_heartbeat.jitter * 1e6:.0f} us, last {client_heartbeat.last_rtt * 1e6:.0f} us")
+	start = time.perf_counter()
+	listener.hang.set()
+	if not disconnected.wait(INTERVAL * MAX_MISSED * 10):
+		raise TimeoutError("The hanging end was not detected")
+	print(f"hanging end detected after {time.perf_counter() - start:.2f} s, with a ping every {INTERVAL} s and at most {MAX_MISSED} missed")
+	client.close()
+	listener.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,107 @@
+"""Measures how fast transports reconnect, and how reconnecting clients spread out after a relay restart.
+
+The legacy connector thread always slept a fixed 5 seconds between attempts.
+"""
+
+import collections
+import threading
+import time
+from . import import_addon_module
+
+transport = import_addon_module('transport')
+
+LEGACY_DELAY = 5
+CLIENTS = 300
+# Seconds the relay is unreachable while it restarts
+RESTART_TIME = 3
+# Width of the windows in which connection attempts to the restarted relay are counted
+WINDOW = 0.1
+
+
+class LegacyConnectorThread(transport.ConnectorThread):
+
+	def run(self):
+		while self.running:
+			try:
+				self.connector.run()
+			except self.run_except:
+				pass
+			time.sleep(LEGACY_DELAY)
+
+	def stop(self):
+		self.running = False
+
+
+class BlipConnector:
+	"""Connects, stays connected for uptime seconds and drops, then records when it is run again."""
+
+	def __init__(self, uptime):
+		self.uptime = uptime
+		self.successful_connects = 0
+		self.dropped_at = None
+		self.reconnected = threading.Event()
+
+	def run(self):
+		if self.dropped_at is not None:
+			self.reconnect_time = time.perf_counter() - self.dropped_at
+			self.reconnected.set()
+			raise OSError("Done")
+		self.successful_connects += 1
+		time.sleep(self.uptime)
+		self.dropped_at = time.perf_counter()
+
+
+class FailingConnector:
+	successful_connects = 0
+
+	def run(self):
+		raise OSError("Connection refused")
+
+
+def measure_blip(thread_class, policy):
+	connector = BlipConnector(policy.stable_time)
+	thread = thread_class(connector, policy=policy)
+	thread.start()
+	connector.reconnected.wait(LEGACY_DELAY * 2)
+	thread.stop()
+	return connector.reconnect_time
+
+
+def measure_close(thread_class, policy):
+	"""Returns the time the thread takes to end once stopped while it waits for the next attempt."""
+	thread = thread_class(FailingConnector(), policy=policy)
+	thread.start()
+	time.sleep(0.2)
+	start = time.perf_counter()
+	thread.stop()
+	thread.join()
+	return time.perf_counter() - start
+
+
+def simulate_restart(get_delay):
+	"""Simulates clients disconnected by a relay restart at time 0, which retry until the relay is back.
+	Returns the time when the last client reconnected and the highest number of attempts within one window after the restart."""
+	windows = collections.Counter()
+	last = 0
+	for i in range(CLIENTS):
+		attempt_time = 0
+		failures = 0
+		while attempt_time < RESTART_TIME:
+			failures += 1
+			attempt_time += get_delay(failures)
+		windows[int(attempt_time / WINDOW)] += 1
+		last = max(last, attempt_time)
+	return last, max(windows.values())
+
+
+def main():
+	policy = transport.ReconnectPolicy(stable_time=0.2)
+	print(f"reconnect after a dropped link: legacy {measure_blip(LegacyConnectorThread, policy):.3f} s, policy {measure_blip(transport.ConnectorThread, policy):.3f} s")
+	print(f"closing while waiting to reconnect: legacy {measure_close(LegacyConnectorThread, policy):.3f} s, policy {measure_close(transport.ConnectorThread, policy):.3f} s")
+	for name, get_delay in (('legacy', lambda failures: LEGACY_DELAY), ('policy', transport.ReconnectPolicy().get_delay)):
+		last, busiest = simulate_restart(get_delay)
+		print(f"{name} after a {RESTART_TIME} s relay restart: all {CLIENTS} clients back after {last:.1f} s, at most {busiest} attempts within {WINDOW * 1e3:.0f} ms")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,170 @@
+"""Measures the time from entering the secure desktop until the first speech of the NVDA instance
+on the secure desktop reaches the slave transport of the instance on the user desktop.
+
+The legacy link starts a TLS relay server, checks it with a TLS test connection and joins it with a relay transport.
+The local link accepts the connection of the secure desktop instance on a plain loopback socket.
+The prepared local link already listens when the secure desktop is entered.
+"""
+
+import socket
+import ssl
+import threading
+import time
+import uuid
+from . import import_addon_module
+
+bridge = import_addon_module('bridge')
+serializer = import_addon_module('serializer')
+server = import_addon_module('server')
+transport = import_addon_module('transport')
+import wx
+
+RUNS = 20
+TIMEOUT = 5
+
+
+class LegacyRelayTransport(transport.RelayTransport):
+	"""The relay transport of the secure desktop instance, without the keep alive settings only available on Windows."""
+
+	def create_outbound_socket(self, address):
+		server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		server_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+		context.check_hostname = False
+		context.verify_mode = ssl.CERT_NONE
+		return context.wrap_socket(server_sock)
+
+
+def create_slave_transport():
+	"""The slave transport of the user desktop instance, which queues what it should send to the master."""
+	result = transport.TCPTransport.__new__(transport.TCPTransport)
+	transport.Transport.__init__(result, serializer=serializer.JSONSerializer())
+	result.queue = transport.SendQueue()
+	result.connected = True
+	return result
+
+
+def start_thread(target):
+	thread = threading.Thread(target=target)
+	thread.daemon = True
+	thread.start()
+
+
+def speak_when_joined(sd_transport):
+	def on_channel_joined(**kwargs):
+		sd_transport.send('speak', sequence=["Windows Security"], priority=0)
+	sd_transport.callback_manager.register_callback('msg_channel_joined', on_channel_joined, thread_safe=True)
+
+
+def wait_until(condition, description):
+	"""Runs the calls made to the main thread until condition returns True."""
+	deadline = time.perf_counter() + TIMEOUT
+	while time.perf_counter() < deadline:
+		wx.process_pending_calls()
+		if condition():
+			return
+		time.sleep(0.0005)
+	raise TimeoutError(f"Timed out waiting for {description}")
+
+
+def run_legacy(slave_transport):
+	channel = str(uuid.uuid4())
+	sd_server = server.Server(port=0, password=channel, bind_host='127.0.0.1', bind_host6='::1')
+	port = sd_server.server_socket.getsockname()[1]
+	start_thread(sd_server.run)
+	sd_relay = transport.RelayTransport(address=('127.0.0.1', port), serializer=serializer.JSONSerializer(), channel=channel)
+	sd_relay.create_outbound_socket = LegacyRelayTransport.create_outbound_socket.__get__(sd_relay)
+	sd_bridge = bridge.BridgeTransport(slave_transport, sd_relay, raw=True)
+	joined = threading.Event()
+	sd_relay.callback_manager.register_callback('msg_channel_joined', lambda **kwargs: joined.set(), thread_safe=True)
+	start_thread(sd_relay.run)
+	# Speech sent before the relay transport joined its channel would be lost
+	wait_until(joined.is_set, "the relay transport to join")
+	leave = lambda: (sd_bridge.disconnect(), sd_relay.close(), sd_server.close())
+	return port, channel, leave
+
+
+def connect_legacy(port, channel):
+	# The secure desktop instance checked the server with a test connection before connecting
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
+	test_socket = context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+	test_socket.connect(('127.0.0.1', port))
+	test_socket.close()
+	return LegacyRelayTransport(address=('127.0.0.1', port), serializer=serializer.JSONSerializer(), channel=channel, connection_type='slave')
+
+
+def run_local(slave_transport):
+	token = str(uuid.uuid4())
+	sd_link = transport.LocalListenerTransport(serializer=serializer.JSONSerializer(), token=token)
+	sd_bridge = bridge.BridgeTransport(slave_transport, sd_link, raw=True)
+	sd_link.reconnector_thread.start()
+	return sd_link.address[1], token, lambda: (sd_bridge.disconnect(), sd_link.close())
+
+
+def connect_local(port, token):
+	return transport.LocalTransport(address=('127.0.0.1', port), serializer=serializer.JSONSerializer(), channel=token, connection_type='slave')
+
+
+class PreparedLink:
+	"""A local link that listens from the moment the slave transport connects,
+	so entering the secure desktop only activates the bridge. It is reused for every run."""
+
+	def __init__(self):
+		self.sd_link = transport.LocalListenerTransport(serializer=serializer.JSONSerializer(), token=str(uuid.uuid4()))
+		self.sd_link.reconnector_thread.start()
+
+	def enter(self, slave_transport):
+		sd_bridge = bridge.BridgeTransport(slave_transport, self.sd_link, raw=True)
+		return self.sd_link.address[1], self.sd_link.token, lambda: self.leave(sd_bridge)
+
+	def leave(self, sd_bridge):
+		sd_bridge.disconnect()
+		self.sd_link.reset(str(uuid.uuid4()))
+
+
+def measure(enter, connect):
+	"""Returns the median time until the user desktop instance is ready for the secure desktop instance,
+	the median time to the first speech and the number of runs where no speech arrived."""
+	ready_times = []
+	times = []
+	failures = 0
+	for i in range(RUNS):
+		slave_transport = create_slave_transport()
+		start = time.perf_counter()
+		try:
+			port, token, leave = enter(slave_transport)
+			ready = time.perf_counter()
+			sd_transport = connect(port, token)
+			speak_when_joined(sd_transport)
+			start_thread(sd_transport.run)
+			wait_until(slave_transport.queue.qsize, "speech from the secure desktop")
+		except TimeoutError:
+			failures += 1
+			continue
+		ready_times.append(ready - start)
+		times.append(time.perf_counter() - start)
+		sd_transport.close()
+		leave()
+	return median(ready_times), median(times), failures
+
+
+def median(values):
+	return sorted(values)[len(values) // 2]
+
+
+def main():
+	prepared = PreparedLink()
+	links = (
+		('TLS relay', run_legacy, connect_legacy),
+		('local link', run_local, connect_local),
+		('prepared local link', prepared.enter, connect_local),
+	)
+	for name, enter, connect in links:
+		ready_time, speech_time, failures = measure(enter, connect)
+		print(f"{name:>19}: ready after {ready_time * 1e3:.2f} ms, first speech after {speech_time * 1e3:.1f} ms (median of {RUNS}, {failures} timed out)")
+
+
+if __name__ == '__main__':
+	main()
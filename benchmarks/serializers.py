@@ -0,0 +1,64 @@
+"""Compares the size and speed of the serializers for the messages sent most often:
+speech sequences with commands, braille display frames and tones."""
+
+import time
+from . import import_addon_module
+
+serializer = import_addon_module('serializer')
+framing = import_addon_module('framing')
+import speech.commands
+
+ITERATIONS = 2000
+
+
+def create_messages():
+	commands = speech.commands
+	return {
+		'speak': dict(type='speak', priority=0, sequence=[
+			commands.CharacterModeCommand(False),
+			"Recycle Bin, list item, 1 of 12, not selected",
+			commands.PitchCommand(offset=20),
+			"Desktop",
+			commands.IndexCommand(42),
+			commands.EndUtteranceCommand(),
+		]),
+		'display': dict(type='display', cells=[(cell * 7) % 256 for cell in range(80)]),
+		'tone': dict(type='tone', hz=880.0, length=40, left=50, right=50),
+	}
+
+
+def measure(instance, message, iterations=ITERATIONS):
+	"""Returns the encoded size and the time to serialize and deserialize the message once."""
+	data = instance.serialize(**message)
+	if instance.binary:
+		payload = data[framing.LengthPrefixFramer.LENGTH.size:]
+	else:
+		payload = data[:-len(serializer.JSONSerializer.SEP)]
+		# Text is written to the DVC as UTF-16
+		size = len(data.encode('utf-16-le', 'surrogatepass'))
+	start = time.perf_counter()
+	for i in range(iterations):
+		instance.serialize(**message)
+	serialize_time = (time.perf_counter() - start) / iterations
+	start = time.perf_counter()
+	for i in range(iterations):
+		instance.deserialize(payload)
+	deserialize_time = (time.perf_counter() - start) / iterations
+	return {'size': len(data) if instance.binary else size, 'serialize': serialize_time, 'deserialize': deserialize_time}
+
+
+def run():
+	results = {}
+	for type, message in create_messages().items():
+		results[type] = {name: measure(cls(), message) for name, cls in serializer.SERIALIZERS.items()}
+	return results
+
+
+def main():
+	for type, results in run().items():
+		for name, result in results.items():
+			print(f"{type:>8} {name:>6}: {result['size']:>4} bytes on the wire, serialize {result['serialize'] * 1e6:.1f} us, deserialize {result['deserialize'] * 1e6:.1f} us")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,97 @@
+"""Measures the cost of one relay server loop pass with a growing number of idle connections.
+
+Every pass handles a single message from one active client, so the difference between
+connection counts is the overhead caused by the idle ones.
+"""
+
+import select
+import socket
+import time
+from . import import_addon_module
+
+server = import_addon_module('server')
+
+CONNECTION_COUNTS = (10, 1000, 10000)
+PASSES = 200
+
+
+class IdleConnection:
+	"""An idle file descriptor. An eventfd only costs one descriptor, a socket pair costs two."""
+
+	def __init__(self):
+		try:
+			from os import eventfd
+			self.fd = eventfd(0)
+			self.peer = None
+		except ImportError:
+			self.sock, self.peer = socket.socketpair()
+			self.fd = self.sock.fileno()
+
+	def fileno(self):
+		return self.fd
+
+	def close(self):
+		if self.peer is None:
+			import os
+			os.close(self.fd)
+		else:
+			self.sock.close()
+			self.peer.close()
+
+
+def time_selector_passes(relay, active, peer):
+	start = time.perf_counter()
+	for i in range(PASSES):
+		peer.sendall(b'{"type": "noop"}\n')
+		relay.poll(0)
+	return (time.perf_counter() - start) / PASSES
+
+
+def time_select_passes(relay, active, peer):
+	"""The loop as it was before the selector: rebuild the socket list and select on every pass."""
+	client_sockets = list(relay.clients)
+	start = time.perf_counter()
+	for i in range(PASSES):
+		peer.sendall(b'{"type": "noop"}\n')
+		r, w, e = select.select(client_sockets + [relay.server_socket, relay.server_socket6], [], client_sockets, 0)
+		for sock in r:
+			relay.clients[sock].handle_data()
+	return (time.perf_counter() - start) / PASSES
+
+
+def run(count):
+	relay = server.Server(port=0, password='bench', bind_host='127.0.0.1', bind_host6='::1')
+	relay.running = True
+	idle = []
+	try:
+		for i in range(count):
+			conn = IdleConnection()
+			idle.append(conn)
+			relay.add_client(server.Client(server=relay, socket=conn))
+		active, peer = socket.socketpair()
+		relay.add_client(server.Client(server=relay, socket=active))
+		result = {'connections': count, 'selector': time_selector_passes(relay, active, peer)}
+		try:
+			result['select'] = time_select_passes(relay, active, peer)
+		except ValueError:
+			# FD_SETSIZE exceeded
+			result['select'] = None
+		peer.close()
+		active.close()
+		return result
+	finally:
+		for conn in idle:
+			conn.close()
+		relay.close()
+		relay.selector.close()
+
+
+def main():
+	for count in CONNECTION_COUNTS:
+		result = run(count)
+		select_time = "unsupported" if result['select'] is None else f"{result['select'] * 1e6:.1f} us"
+		print(f"{count:>6} idle connections: selector {result['selector'] * 1e6:.1f} us, select {select_time} per pass")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,109 @@
+"""Compares the JSON serializer against the previous implementation,
+which decoded every dict through an object hook and checked every encoded object with issubclass."""
+
+import json
+import time
+from . import import_addon_module
+
+serializer = import_addon_module('serializer')
+import speech.commands
+
+ITERATIONS = 5000
+
+
+class LegacyEncoder(json.JSONEncoder):
+
+	def default(self, obj):
+		if is_subclass_or_instance(obj, serializer.SEQUENCE_CLASSES):
+			return [obj.__class__.__name__, obj.__dict__]
+		return super().default(obj)
+
+
+def is_subclass_or_instance(unknown, possible):
+	try:
+		return issubclass(unknown, possible)
+	except TypeError:
+		return isinstance(unknown, possible)
+
+
+def as_sequence(dct):
+	if not ('type' in dct and dct['type'] == 'speak' and 'sequence' in dct):
+		return dct
+	sequence = []
+	for item in dct['sequence']:
+		if not isinstance(item, list):
+			sequence.append(item)
+			continue
+		name, values = item
+		if not hasattr(speech.commands, name):
+			continue
+		cls = getattr(speech.commands, name)
+		if not issubclass(cls, serializer.SEQUENCE_CLASSES):
+			continue
+		cls = cls.__new__(cls)
+		cls.__dict__.update(values)
+		sequence.append(cls)
+	dct['sequence'] = sequence
+	return dct
+
+
+class LegacySerializer:
+
+	def serialize(self, type=None, **obj):
+		obj['type'] = type
+		return json.dumps(obj, cls=LegacyEncoder) + "\n"
+
+	def deserialize(self, data):
+		return json.loads(data, object_hook=as_sequence)
+
+
+def create_messages():
+	commands = speech.commands
+	return {
+		'say all': dict(type='speak', priority=0, sequence=[
+			"It was a bright cold day in April, and the clocks were striking thirteen.",
+			"Winston Smith, his chin nuzzled into his breast in an effort to escape the vile wind, slipped quickly through the glass doors.",
+		]),
+		'commands': dict(type='speak', priority=0, sequence=[
+			commands.CharacterModeCommand(False),
+			"Recycle Bin, list item, 1 of 12",
+			commands.PitchCommand(offset=20),
+			"Desktop",
+			commands.IndexCommand(42),
+			commands.EndUtteranceCommand(),
+		]),
+		'braille info': dict(type='set_braille_info', name='seika', numCells=40, client=dict(id=1, connection_type='master')),
+	}
+
+
+def time_per_call(function, argument, iterations=ITERATIONS):
+	start = time.perf_counter()
+	for i in range(iterations):
+		function(argument)
+	return (time.perf_counter() - start) / iterations
+
+
+def run():
+	legacy = LegacySerializer()
+	current = serializer.JSONSerializer()
+	results = {}
+	for type, message in create_messages().items():
+		data = current.serialize(**message)
+		# The current serializer writes the type first, so the encodings are compared decoded
+		assert json.loads(data) == json.loads(legacy.serialize(**message))
+		results[type] = {
+			'legacy_encode': time_per_call(lambda message: legacy.serialize(**message), message),
+			'current_encode': time_per_call(lambda message: current.serialize(**message), message),
+			'legacy_decode': time_per_call(legacy.deserialize, data),
+			'current_decode': time_per_call(current.deserialize, data),
+		}
+	return results
+
+
+def main():
+	for type, result in run().items():
+		print(f"{type:>12}: encode {result['legacy_encode'] * 1e6:.1f} -> {result['current_encode'] * 1e6:.1f} us, decode {result['legacy_decode'] * 1e6:.1f} -> {result['current_decode'] * 1e6:.1f} us")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,32 @@
+"""Stand-in for NVDA's braille module, with a handler for a 40 cell display."""
+
+import inputCore
+
+
+class BrailleDisplayGesture(inputCore.InputGesture):
+	source = "stub"
+	model = None
+	id = None
+
+
+class BrailleDisplayDriver:
+	name = "stub"
+	numCells = 40
+	gestureMap = None
+
+
+class BrailleHandler:
+
+	def __init__(self):
+		self.display = BrailleDisplayDriver()
+		self.displaySize = self.display.numCells
+		self.enabled = True
+
+	def _writeCells(self, cells):
+		pass
+
+	def setDisplayByName(self, name, *args, **kwargs):
+		return True
+
+
+handler = BrailleHandler()
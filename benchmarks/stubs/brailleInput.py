@@ -0,0 +1,8 @@
+"""Stand-in for NVDA's brailleInput module."""
+
+import inputCore
+
+
+class BrailleInputGesture(inputCore.InputGesture):
+	dots = 0
+	space = False
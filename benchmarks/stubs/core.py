@@ -0,0 +1,7 @@
+"""Stand-in for NVDA's core module."""
+
+import wx
+
+
+def callLater(delay, callable, *args, **kwargs):
+	return wx.CallLater(delay, callable, *args, **kwargs)
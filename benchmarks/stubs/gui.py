@@ -0,0 +1,3 @@
+"""Stand-in for NVDA's gui package, which the patchers import but don't use."""
+
+mainFrame = None
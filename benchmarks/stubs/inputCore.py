@@ -0,0 +1,35 @@
+"""Stand-in for NVDA's inputCore module."""
+
+
+class NoInputGestureAction(LookupError):
+	pass
+
+
+class InputGesture:
+	script = None
+	identifiers = ()
+
+
+class GlobalGestureMap:
+	"""Maps gesture identifiers to (script class, script name) pairs."""
+
+	def __init__(self, entries=None):
+		self.entries = entries or {}
+
+	def getScriptsForGesture(self, identifier):
+		script = self.entries.get(identifier)
+		if script is not None:
+			yield script
+
+
+class InputManager:
+
+	def __init__(self):
+		self.userGestureMap = GlobalGestureMap()
+		self.localeGestureMap = GlobalGestureMap()
+
+	def executeGesture(self, gesture):
+		raise NoInputGestureAction
+
+
+manager = InputManager()
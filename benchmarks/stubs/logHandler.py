@@ -0,0 +1,16 @@
+"""Stand-in for NVDA's logHandler module."""
+
+import logging
+
+
+class Logger(logging.Logger):
+
+	def debugWarning(self, msg, *args, **kwargs):
+		self.debug(msg, *args, **kwargs)
+
+	def io(self, msg, *args, **kwargs):
+		self.debug(msg, *args, **kwargs)
+
+
+log = Logger('nvda')
+log.addHandler(logging.NullHandler())
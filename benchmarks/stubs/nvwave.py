@@ -0,0 +1,5 @@
+"""Stand-in for NVDA's nvwave module."""
+
+
+def playWaveFile(fileName, asynchronous=True):
+	pass
@@ -0,0 +1,9 @@
+"""Stand-in for NVDA's scriptHandler module."""
+
+
+def getScriptName(script):
+	return script.__name__[len("script_"):]
+
+
+def getScriptLocation(script):
+	return f"{script.__self__.__module__}.{script.__self__.__class__.__name__}"
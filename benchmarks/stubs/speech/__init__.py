@@ -0,0 +1,18 @@
+"""Stand-in for NVDA's speech package, which exposes the speech commands at package level as well."""
+
+from . import commands
+from . import priorities
+from .commands import *  # noqa: F401, F403
+
+
+class SpeechManager:
+
+	def speak(self, speechSequence, priority):
+		pass
+
+	def cancel(self):
+		pass
+
+
+_manager = SpeechManager()
+beenCanceled = True
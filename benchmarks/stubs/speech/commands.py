@@ -0,0 +1,44 @@
+"""Stand-in for the speech commands of NVDA's speech.commands module that are sent between machines."""
+
+
+class SpeechCommand:
+	pass
+
+
+class SynthCommand(SpeechCommand):
+	pass
+
+
+class IndexCommand(SynthCommand):
+
+	def __init__(self, index):
+		self.index = index
+
+
+class CharacterModeCommand(SynthCommand):
+
+	def __init__(self, state):
+		self.state = state
+
+
+class LangChangeCommand(SynthCommand):
+
+	def __init__(self, lang):
+		self.lang = lang
+
+
+class BreakCommand(SynthCommand):
+
+	def __init__(self, time=0):
+		self.time = time
+
+
+class PitchCommand(SynthCommand):
+
+	def __init__(self, offset=0, multiplier=1):
+		self.offset = offset
+		self.multiplier = multiplier
+
+
+class EndUtteranceCommand(SpeechCommand):
+	pass
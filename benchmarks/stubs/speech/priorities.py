@@ -0,0 +1,9 @@
+"""Stand-in for NVDA's speech.priorities module."""
+
+import enum
+
+
+class Spri(enum.IntEnum):
+	NORMAL = 0
+	NEXT = 1
+	NOW = 2
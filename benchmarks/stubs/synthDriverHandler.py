@@ -0,0 +1,5 @@
+"""Stand-in for NVDA's synthDriverHandler module."""
+
+
+def getSynth():
+	return None
@@ -0,0 +1,12 @@
+"""Stand-in for winreg on other platforms. No key exists."""
+
+HKEY_CLASSES_ROOT = HKEY_LOCAL_MACHINE = 0
+KEY_READ = KEY_WOW64_32KEY = 0
+
+
+def OpenKey(*args, **kwargs):
+	raise OSError("Registry is not available")
+
+
+def QueryValueEx(*args, **kwargs):
+	raise OSError("Registry is not available")
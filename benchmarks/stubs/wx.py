@@ -0,0 +1,28 @@
+"""Stand-in for wxPython. Calls made with CallAfter are queued until process_pending_calls runs them,
+like the main loop of NVDA would."""
+
+import collections
+
+pending_calls = collections.deque()
+
+
+def CallAfter(callable, *args, **kwargs):
+	pending_calls.append((callable, args, kwargs))
+
+
+def process_pending_calls():
+	count = 0
+	while pending_calls:
+		callable, args, kwargs = pending_calls.popleft()
+		callable(*args, **kwargs)
+		count += 1
+	return count
+
+
+class CallLater:
+
+	def __init__(self, millis, callable, *args, **kwargs):
+		CallAfter(callable, *args, **kwargs)
+
+	def Stop(self):
+		pass
@@ -0,0 +1,287 @@
+"""Times the hot paths of the add-on with the NVDA stand-ins and saves the results as JSON, so runs can be compared.
+
+Run from the root of the repository:
+	python -m benchmarks.suite --output before.json
+	python -m benchmarks.suite --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from . import import_addon_module
+
+callback_manager = import_addon_module('callback_manager')
+framing = import_addon_module('framing')
+nvda_patcher = import_addon_module('nvda_patcher')
+serializer = import_addon_module('serializer')
+server = import_addon_module('server')
+transport = import_addon_module('transport')
+import braille
+import brailleInput
+import inputCore
+import speech.commands
+import wx
+
+# Each benchmark runs for at least MIN_TIME seconds per round, the fastest of ROUNDS rounds is kept
+MIN_TIME = 0.2
+ROUNDS = 5
+# Messages of a received burst, clients of a relay channel and callbacks called at once
+BURST_SIZE = 100
+CHANNEL_SIZE = 10
+CALLBACK_BATCH = 10
+
+
+def create_speech_sequences():
+	"""Speech of moving through a document and a list, with the commands NVDA puts in between."""
+	commands = speech.commands
+	return [
+		[commands.LangChangeCommand("en_US"), "Heading level 2", "Release notes", commands.EndUtteranceCommand()],
+		[commands.CharacterModeCommand(False), "Recycle Bin, list item, 1 of 12, not selected", commands.IndexCommand(42)],
+		[
+			"The quick brown fox jumps over the lazy dog. ", commands.IndexCommand(1),
+			"Pack my box with five dozen liquor jugs. ", commands.IndexCommand(2),
+			commands.PitchCommand(offset=20), "Link", commands.PitchCommand(), "visited", commands.BreakCommand(100),
+		],
+		[commands.CharacterModeCommand(True), "a", commands.CharacterModeCommand(False)],
+	]
+
+
+def create_messages(count):
+	sequences = create_speech_sequences()
+	messages = []
+	for i in range(count):
+		if i % 4 == 3:
+			messages.append(dict(type='display', cells=[(i + cell) % 256 for cell in range(40)]))
+		else:
+			messages.append(dict(type='speak', sequence=sequences[i % len(sequences)], priority=0))
+	return messages
+
+
+def cycle(items):
+	"""Returns a function returning the next of items on every call, starting over after the last."""
+	state = {'index': 0}
+	def next_item():
+		index = state['index']
+		state['index'] = (index + 1) % len(items)
+		return items[index]
+	return next_item
+
+
+def bench_serialize(name):
+	instance = serializer.SERIALIZERS[name]()
+	next_sequence = cycle(create_speech_sequences())
+	return lambda: instance.serialize(type='speak', sequence=next_sequence(), priority=0), 1
+
+
+def bench_deserialize(name):
+	instance = serializer.SERIALIZERS[name]()
+	payloads = []
+	for sequence in create_speech_sequences():
+		data = instance.serialize(type='speak', sequence=sequence, priority=0)
+		if instance.binary:
+			payloads.append(data[framing.LengthPrefixFramer.LENGTH.size:])
+		else:
+			payloads.append(data[:-len(serializer.JSONSerializer.SEP)])
+	next_payload = cycle(payloads)
+	return lambda: instance.deserialize(next_payload()), 1
+
+
+class ChunkSocket:
+	"""A connected socket that receives the same chunks over and over."""
+
+	def __init__(self, chunks):
+		self.next_chunk = cycle(chunks)
+
+	def recv(self, size):
+		return self.next_chunk()
+
+
+def bench_handle_server_data():
+	"""A burst of messages received in 16 kB reads, framed, decoded and dispatched to the main thread."""
+	json_serializer = serializer.JSONSerializer()
+	data = "".join(json_serializer.serialize(**message) for message in create_messages(BURST_SIZE)).encode()
+	chunks = [data[offset:offset + 16384] for offset in range(0, len(data), 16384)]
+	tcp_transport = transport.TCPTransport(serializer=json_serializer, address=('127.0.0.1', 0))
+	server_sock = ChunkSocket(chunks)
+	tcp_transport.callback_manager.register_callback('msg_speak', lambda **kwargs: None)
+	tcp_transport.callback_manager.register_callback('msg_display', lambda **kwargs: None)
+	def receive_burst():
+		for chunk in chunks:
+			tcp_transport.handle_server_data(server_sock)
+		wx.process_pending_calls()
+	return receive_burst, BURST_SIZE
+
+
+def bench_call_callbacks():
+	"""Events with two main thread callbacks and a thread safe callback to all events, as a slave with a secure desktop bridge has."""
+	manager = callback_manager.CallbackManager()
+	manager.register_callback('msg_speak', lambda **kwargs: None)
+	manager.register_callback('msg_speak', lambda **kwargs: None)
+	manager.register_callback('*', lambda type, **kwargs: None, thread_safe=True)
+	sequence = create_speech_sequences()[0]
+	def call_batch():
+		with manager.batch():
+			for i in range(CALLBACK_BATCH):
+				manager.call_callbacks('msg_speak', sequence=sequence, priority=0)
+		wx.process_pending_calls()
+	return call_batch, CALLBACK_BATCH
+
+
+class RelayServer(server.BaseServer):
+	"""Relay bookkeeping without sockets or event loop."""
+
+	def __init__(self):
+		super().__init__(port=0, password='bench')
+		self.pending_writes = set()
+
+
+class NullSocket:
+
+	def close(self):
+		pass
+
+
+def bench_client_parse():
+	"""A speech message relayed by the server to the other clients of its channel, which are written to their buffers."""
+	relay = RelayServer()
+	clients = []
+	for i in range(CHANNEL_SIZE):
+		client = server.Client(server=relay, socket=NullSocket())
+		relay.add_client(client)
+		client.do_join(dict(channel='bench', connection_type='master' if i else 'slave'))
+		clients.append(client)
+	sender = clients[0]
+	line = serializer.JSONSerializer().serialize(**create_messages(1)[0]).rstrip("\n")
+	def relay_message():
+		sender.parse(line)
+		for client in clients:
+			del client.outbuf[:]
+		relay.pending_writes.clear()
+	return relay_message, 1
+
+
+class BrailleDisplayGesture(braille.BrailleDisplayGesture):
+
+	def __init__(self, id, script=None):
+		self.id = id
+		self.identifiers = [f"br(stub):{id}"]
+		self.script = script
+		self.model = "stub"
+
+
+class BrailleInputGesture(brailleInput.BrailleInputGesture):
+
+	def __init__(self, dots):
+		self.dots = dots
+		self.identifiers = [f"bk:dot{dots}"]
+
+
+class ReviewScripts:
+
+	def script_braille_routing(self, gesture):
+		pass
+
+	def script_kb_enter(self, gesture):
+		pass
+
+
+def bench_execute_gesture():
+	"""Braille gestures of a master converted to braille input messages:
+	with a script, found through the gesture maps, and typed dots."""
+	scripts = ReviewScripts()
+	inputCore.manager.userGestureMap = inputCore.GlobalGestureMap({'br(stub):d1': (ReviewScripts, 'braille_scrollBack')})
+	patcher = nvda_patcher.NVDAMasterPatcher()
+	patcher.register_callback('braille_input', lambda **kwargs: None)
+	gestures = [
+		BrailleDisplayGesture('routing', script=scripts.script_braille_routing),
+		BrailleDisplayGesture('enter', script=scripts.script_kb_enter),
+		BrailleDisplayGesture('d1'),
+		BrailleInputGesture(dots=0b1011),
+	]
+	def execute_gestures():
+		for gesture in gestures:
+			patcher.executeGesture(gesture)
+		wx.process_pending_calls()
+	return execute_gestures, len(gestures)
+
+
+BENCHMARKS = {
+	'serialize json speech': lambda: bench_serialize('json'),
+	'serialize binary speech': lambda: bench_serialize('binary'),
+	'deserialize json speech': lambda: bench_deserialize('json'),
+	'deserialize binary speech': lambda: bench_deserialize('binary'),
+	'TCPTransport.handle_server_data': bench_handle_server_data,
+	'CallbackManager.call_callbacks': bench_call_callbacks,
+	'server.Client.parse fan-out': bench_client_parse,
+	'NVDAMasterPatcher.executeGesture': bench_execute_gesture,
+}
+
+
+def measure(function, operations):
+	"""Returns the fastest time of one operation over the rounds, in seconds.
+	function performs operations operations per call."""
+	calls = 1
+	while True:
+		start = time.perf_counter()
+		for i in range(calls):
+			function()
+		elapsed = time.perf_counter() - start
+		if elapsed >= MIN_TIME:
+			break
+		calls *= 2
+	best = elapsed
+	for round in range(ROUNDS - 1):
+		start = time.perf_counter()
+		for i in range(calls):
+			function()
+		best = min(best, time.perf_counter() - start)
+	return best / calls / operations
+
+
+def run(names):
+	results = {}
+	for name in names:
+		function, operations = BENCHMARKS[name]()
+		results[name] = {'seconds': measure(function, operations), 'operations': operations}
+	return results
+
+
+def compare(results, previous):
+	for name, result in results.items():
+		before = previous.get(name)
+		line = f"{name:>34}: {result['seconds'] * 1e6:9.2f} us"
+		if before:
+			line += f", was {before['seconds'] * 1e6:9.2f} us ({before['seconds'] / result['seconds']:.2f}x)"
+		print(line)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	parser.add_argument('--output', help="File to save the results to, as JSON")
+	parser.add_argument('--compare', help="Results of an earlier run to compare with")
+	parser.add_argument('benchmarks', nargs='*', metavar='benchmark', help=f"Benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+	args = parser.parse_args()
+	unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+	if unknown:
+		parser.error(f"Unknown benchmarks: {', '.join(unknown)}")
+	results = run(args.benchmarks or list(BENCHMARKS))
+	previous = {}
+	if args.compare:
+		with open(args.compare) as file:
+			previous = json.load(file)['results']
+	compare(results, previous)
+	if args.output:
+		report = {
+			'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+			'python': sys.version.split()[0],
+			'platform': platform.platform(),
+			'results': results,
+		}
+		with open(args.output, 'w') as file:
+			json.dump(report, file, indent='\t')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,99 @@
+"""Measures the TLS handshakes of a reconnect storm, when many clients connect to the relay again at once.
+
+Every client connects once to get a session, then all of them reconnect:
+with a new context for every connection as ssl.wrap_socket did, with the shared client context,
+and with the shared client context resuming the session of the previous connection.
+CPU time is that of the whole process, so it covers both the clients and the server.
+"""
+
+import socket
+import ssl
+import threading
+import time
+from . import import_addon_module
+
+server = import_addon_module('server')
+transport = import_addon_module('transport')
+
+CLIENTS = 300
+
+
+class HandshakeServer:
+	"""Accepts connections with the context of the relay servers and sends a byte once the handshake is done,
+	like the relay answers a join. Reading it lets the client receive its TLS 1.3 session ticket."""
+
+	def __init__(self):
+		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listen_socket.bind(('127.0.0.1', 0))
+		self.listen_socket.listen(CLIENTS)
+		self.address = self.listen_socket.getsockname()
+		self.context = server.get_server_context()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		while True:
+			try:
+				sock, address = self.listen_socket.accept()
+			except OSError:
+				return
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			try:
+				with self.context.wrap_socket(sock, server_side=True) as tls_sock:
+					tls_sock.sendall(b'\n')
+					tls_sock.recv(1)
+			except (ssl.SSLError, OSError):
+				pass
+
+	def close(self):
+		self.listen_socket.close()
+
+
+def legacy_context():
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
+	return context
+
+
+def connect(address, context, session=None):
+	"""Connects and waits for the server, returns the session to resume and whether this connection resumed one."""
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	with context.wrap_socket(sock, session=session) as tls_sock:
+		tls_sock.connect(address)
+		tls_sock.recv(1)
+		return tls_sock.session, tls_sock.session_reused
+
+
+def storm(address, get_context, resume):
+	sessions = [connect(address, transport.client_context)[0] for i in range(CLIENTS)]
+	resumed = 0
+	wall_start = time.perf_counter()
+	cpu_start = time.process_time()
+	for session in sessions:
+		session, reused = connect(address, get_context(), session if resume else None)
+		resumed += reused
+	wall = time.perf_counter() - wall_start
+	cpu = time.process_time() - cpu_start
+	return wall / CLIENTS, cpu / CLIENTS, resumed
+
+
+def main():
+	handshake_server = HandshakeServer()
+	address = handshake_server.address
+	print(f"{CLIENTS} clients reconnecting, {ssl.OPENSSL_VERSION}")
+	modes = (
+		('context per connection', legacy_context, False),
+		('shared context', lambda: transport.client_context, False),
+		('shared context, resumed', lambda: transport.client_context, True),
+	)
+	for name, get_context, resume in modes:
+		wall, cpu, resumed = storm(address, get_context, resume)
+		print(f"{name:>24}: {wall * 1e3:.2f} ms and {cpu * 1e3:.2f} ms CPU per connection, {resumed} resumed")
+	handshake_server.close()
+
+
+if __name__ == '__main__':
+	main()
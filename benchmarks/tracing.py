@@ -0,0 +1,79 @@
+"""Sends traced speech from a slave to a master through a relay server on loopback and prints the latency of each stage,
+then measures what tracing adds to sending a message.
+"""
+
+import threading
+import time
+import uuid
+from . import import_addon_module
+from .secure_desktop import LegacyRelayTransport, create_slave_transport, start_thread, wait_until
+
+heartbeat = import_addon_module('heartbeat')
+serializer = import_addon_module('serializer')
+server = import_addon_module('server')
+tracing = import_addon_module('tracing')
+
+MESSAGES = 200
+# Seconds between speech messages, like a user moving quickly through a document
+SPEECH_INTERVAL = 0.005
+HEARTBEAT_INTERVAL = 0.05
+SEND_COUNT = 20000
+
+
+def connect(port, channel, connection_type):
+	result = LegacyRelayTransport(address=('127.0.0.1', port), serializer=serializer.JSONSerializer(), channel=channel, connection_type=connection_type, heartbeat=heartbeat.Heartbeat(interval=HEARTBEAT_INTERVAL))
+	joined = threading.Event()
+	result.callback_manager.register_callback('msg_channel_joined', lambda **kwargs: joined.set(), thread_safe=True)
+	start_thread(result.run)
+	wait_until(joined.is_set, f"the {connection_type} to join")
+	return result
+
+
+def trace_relay():
+	channel = str(uuid.uuid4())
+	relay = server.Server(port=0, password=channel, bind_host='127.0.0.1', bind_host6='::1')
+	start_thread(relay.run)
+	port = relay.server_socket.getsockname()[1]
+	master = connect(port, channel, 'master')
+	slave = connect(port, channel, 'slave')
+	received = []
+	def on_speak(trace=None, **kwargs):
+		tracing.tracer.finish('speak', trace)
+		received.append(trace)
+	master.callback_manager.register_callback('msg_speak', on_speak, thread_safe=True)
+	# Lets the heartbeats estimate the clock offsets to the relay
+	wait_until(lambda: master.heartbeat.clock_offset is not None and slave.heartbeat.clock_offset is not None, "the clock offsets")
+	for i in range(MESSAGES):
+		slave.send('speak', sequence=[f"Line {i}"], priority=0, trace=tracing.tracer.start())
+		time.sleep(SPEECH_INTERVAL)
+	wait_until(lambda: len(received) == MESSAGES, "the traced speech")
+	print(f"clock offsets to the relay: master {master.heartbeat.clock_offset * 1e6:.0f} us, slave {slave.heartbeat.clock_offset * 1e6:.0f} us")
+	print(tracing.tracer.report())
+	slave.close()
+	master.close()
+	relay.close()
+
+
+def measure_send(trace):
+	"""Returns the time to send a speech message and take it from the send queue, in microseconds."""
+	slave_transport = create_slave_transport()
+	start = time.perf_counter()
+	for i in range(SEND_COUNT):
+		slave_transport.send('speak', sequence=["Line"], priority=0, trace=tracing.tracer.start() if trace else None)
+		slave_transport.get_batch()
+	return (time.perf_counter() - start) / SEND_COUNT * 1e6
+
+
+def main():
+	tracing.tracer.enabled = True
+	print(f"{MESSAGES} speech messages through a loopback relay, by stage")
+	trace_relay()
+	tracing.tracer.enabled = False
+	untraced = measure_send(False)
+	tracing.tracer.enabled = True
+	traced = measure_send(True)
+	print(f"send and batch one speech message: {untraced:.2f} us untraced, {traced:.2f} us traced")
+
+
+if __name__ == '__main__':
+	main()